@@ -0,0 +1,97 @@
+"""
+Benchmark: pedidos normalizados como dict vs OrderRecord (__slots__).
+
+Uso (desde la raíz del repo):
+    python -m benchmarks.order_records [num_pedidos] [rondas]
+"""
+
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+
+from main import OrderRecord
+
+ESTADOS = ["ENTREGADO", "DEVOLUCION", "CANCELADO", "EN_RUTA", "PENDIENTE"]
+
+
+def upstream_orders(n: int) -> list:
+    """Pedidos como los devuelve get_orders_financial_details."""
+    return [
+        {
+            "order_id": 1_000_000 + i,
+            "status": random.choice(ESTADOS).lower(),
+            "profit": round(random.uniform(50, 150), 2),
+            "shipping_cost": round(random.uniform(15, 30), 2),
+            "paid": random.random() < 0.5,
+            "payment_amount": round(random.uniform(100, 300), 2),
+        }
+        for i in range(n)
+    ]
+
+
+def as_dicts(orders: list) -> list:
+    return [
+        {
+            "id": o.get("order_id"),
+            "status": (o.get("status") or "").upper(),
+            "profit": o.get("profit") or 0,
+            "shipping_cost": o.get("shipping_cost") or 0,
+            "paid": bool(o.get("paid")),
+            "payment_amount": o.get("payment_amount") or 0,
+        }
+        for o in orders
+    ]
+
+
+def as_records(orders: list) -> list:
+    return [OrderRecord.from_detail(o) for o in orders]
+
+
+def measure_memory(build, orders: list):
+    tracemalloc.start()
+    normalized = build(orders)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return normalized, size
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    orders = upstream_orders(n)
+    variants = [
+        ("dict", as_dicts, lambda o: o["profit"]),
+        ("OrderRecord", as_records, lambda o: o.profit),
+    ]
+
+    # Una ronda de calentamiento y luego rondas alternando el orden de las
+    # variantes, para que ninguna se beneficie de ir primero o segunda
+    builds = {name: [] for name, _, _ in variants}
+    scans = {name: [] for name, _, _ in variants}
+    for i in range(rounds + 1):
+        for name, build, profit in (variants if i % 2 else variants[::-1]):
+            start = time.perf_counter()
+            normalized = build(orders)
+            elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            sum(profit(o) for o in normalized)
+            scan = time.perf_counter() - start
+            del normalized
+            if i > 0:
+                builds[name].append(elapsed)
+                scans[name].append(scan)
+
+    print(f"{n:,} pedidos, mediana de {rounds} rondas")
+    for name, build, _ in variants:
+        _, size = measure_memory(build, orders)
+        print(
+            f"  {name:<12} crear {statistics.median(builds[name]) * 1000:7.1f} ms   "
+            f"recorrer {statistics.median(scans[name]) * 1000:6.1f} ms   "
+            f"memoria {size / 1024 / 1024:6.1f} MB ({size / n:.0f} B/pedido)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,8 +8,20 @@ Funciona para Guatemala y Colombia (fletes variables).
 import os
 import json
 import httpx
+import numpy as np
 import asyncio
-from datetime import datetime, timedelta
+import concurrent.futures
+import contextlib
+import contextvars
+import logging
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import asdict, dataclass, field, fields
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv
 from starlette.applications import Starlette
 from starlette.routing import Route
@@ -19,6 +31,8 @@ import uvicorn
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ==============================================================================
 # CONFIGURACIÓN - URLs de los servidores MCP
 # ==============================================================================
@@ -31,43 +45,1469 @@ META_MCP_URL = os.getenv("META_MCP_URL", "https://server-meta-production-4773.up
 # Moneda según país (se detecta de Dropi)
 CURRENCY_SYMBOL = os.getenv("CURRENCY_SYMBOL", "Q")  # Q para Guatemala, $ para Colombia
 
+# Pool HTTP hacia los servidores MCP (un cliente persistente por upstream)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_HTTP2 = os.getenv("HTTP_HTTP2", "false").lower() in ("1", "true", "yes")
+
+# Timeout por fuente (segundos) para resumen_rapido
+RESUMEN_SOURCE_TIMEOUT = float(os.getenv("RESUMEN_SOURCE_TIMEOUT", "10"))
+
+# Detalles financieros de Dropi: tamaño de lote y lotes simultáneos
+FINANCIAL_BATCH_SIZE = int(os.getenv("FINANCIAL_BATCH_SIZE", "50"))
+FINANCIAL_MAX_CONCURRENCY = int(os.getenv("FINANCIAL_MAX_CONCURRENCY", "4"))
+
+# Paginación de get_dropi_orders (pedidos por página y tope de páginas)
+DROPI_PAGE_SIZE = int(os.getenv("DROPI_PAGE_SIZE", "500"))
+DROPI_MAX_PAGES = int(os.getenv("DROPI_MAX_PAGES", "200"))
+
+# Caché de respuestas de los servidores MCP (TTL + LRU)
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1000"))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", str(50 * 1024 * 1024)))
+CACHE_DEFAULT_TTL = float(os.getenv("CACHE_DEFAULT_TTL", "120"))
+CACHE_CLOSED_RANGE_TTL = float(os.getenv("CACHE_CLOSED_RANGE_TTL", "3600"))
+
+# Reintentos para lecturas idempotentes (backoff exponencial con jitter)
+RETRY_ATTEMPTS = int(os.getenv("RETRY_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "5"))
+
+# Circuit breaker por upstream
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+
+# Limitador por upstream: token bucket (peticiones/s) + concurrencia adaptativa (AIMD)
+LIMITER_RATE = float(os.getenv("LIMITER_RATE", "20"))
+LIMITER_BURST = float(os.getenv("LIMITER_BURST", "40"))
+LIMITER_MIN_CONCURRENCY = int(os.getenv("LIMITER_MIN_CONCURRENCY", "2"))
+LIMITER_MAX_CONCURRENCY = int(os.getenv("LIMITER_MAX_CONCURRENCY", "16"))
+LIMITER_INITIAL_CONCURRENCY = int(os.getenv("LIMITER_INITIAL_CONCURRENCY", "8"))
+LIMITER_LATENCY_TARGET = float(os.getenv("LIMITER_LATENCY_TARGET", "10"))
+LIMITER_BACKOFF = float(os.getenv("LIMITER_BACKOFF", "0.7"))
+
+# Deadline total por herramienta (segundos); se puede pasar deadline_seconds
+TOOL_DEADLINES = {
+    "analisis_360": float(os.getenv("DEADLINE_ANALISIS_360", "90")),
+    "proyeccion_pendientes": float(os.getenv("DEADLINE_PROYECCION_PENDIENTES", "60")),
+    "resumen_rapido": float(os.getenv("DEADLINE_RESUMEN_RAPIDO", "15")),
+}
+# Fracción del deadline para el listado de Dropi (el resto queda para los detalles)
+DEADLINE_LISTING_SHARE = float(os.getenv("DEADLINE_LISTING_SHARE", "0.6"))
+
+# Hedging: segunda petición idéntica si la primera tarda más que el percentil
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_TOOLS = {t.strip() for t in os.getenv("HEDGE_TOOLS", "get_dropi_orders").split(",") if t.strip()}
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+HEDGE_MAX_FRACTION = float(os.getenv("HEDGE_MAX_FRACTION", "0.1"))
+
+# Base de datos local (SQLite) y agregados diarios de analisis_360
+ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", "analytics.db")
+CLOSED_DAY_MIN_AGE_DAYS = int(os.getenv("CLOSED_DAY_MIN_AGE_DAYS", "2"))
+DAILY_MAX_CONCURRENCY = int(os.getenv("DAILY_MAX_CONCURRENCY", "4"))
+MAX_RANGE_DAYS = int(os.getenv("MAX_RANGE_DAYS", "366"))
+# Antigüedad máxima (segundos) de los datos de Dropi en el almacén local
+STORE_SYNC_MAX_AGE = float(os.getenv("STORE_SYNC_MAX_AGE", "300"))
+# Detalles financieros finales que se mantienen además en memoria
+FINANCIAL_CACHE_MAX_ENTRIES = int(os.getenv("FINANCIAL_CACHE_MAX_ENTRIES", "100000"))
+# Snapshots de pedidos por período que comparten las herramientas
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "300"))
+SNAPSHOT_MAX_ENTRIES = int(os.getenv("SNAPSHOT_MAX_ENTRIES", "32"))
+
+# Máximo de IDs que se listan en el reporte
+MAX_LISTED_IDS = 10
+
+# Simulación Monte Carlo de proyeccion_pendientes
+MONTE_CARLO_MAX_SIMULATIONS = int(os.getenv("MONTE_CARLO_MAX_SIMULATIONS", "100000"))
+MONTE_CARLO_HISTORY_DAYS = int(os.getenv("MONTE_CARLO_HISTORY_DAYS", "90"))
+MONTE_CARLO_DEFAULT_RATE = float(os.getenv("MONTE_CARLO_DEFAULT_RATE", "80"))
+# Pedidos resueltos mínimos para usar la tasa de entrega de un estado concreto
+MONTE_CARLO_MIN_STATUS_SAMPLES = int(os.getenv("MONTE_CARLO_MIN_STATUS_SAMPLES", "20"))
+# Muestras × pedidos por bloque (acota la memoria de cada sorteo)
+MONTE_CARLO_BLOCK_CELLS = int(os.getenv("MONTE_CARLO_BLOCK_CELLS", "4000000"))
+# Procesos para simulaciones grandes (0 = en un hilo del proceso principal)
+MONTE_CARLO_PROCESSES = int(os.getenv("MONTE_CARLO_PROCESSES", "0"))
+MONTE_CARLO_POOL_MIN_CELLS = int(os.getenv("MONTE_CARLO_POOL_MIN_CELLS", "50000000"))
+
+# Precálculo en segundo plano (intervalos y antigüedad máxima en segundos)
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "true").lower() in ("1", "true", "yes")
+PREFETCH_RESUMEN_INTERVAL = float(os.getenv("PREFETCH_RESUMEN_INTERVAL", "120"))
+PREFETCH_ANALISIS_INTERVAL = float(os.getenv("PREFETCH_ANALISIS_INTERVAL", "600"))
+PREFETCH_ANALISIS_DAYS = int(os.getenv("PREFETCH_ANALISIS_DAYS", "2"))
+PREFETCH_MAX_STALENESS = float(os.getenv("PREFETCH_MAX_STALENESS", "900"))
+
+# Llamadas a herramientas simultáneas por sesión SSE (las demás esperan turno)
+SESSION_MAX_CONCURRENT_CALLS = int(os.getenv("SESSION_MAX_CONCURRENT_CALLS", "4"))
+# Llamadas que pueden esperar turno; las que excedan se rechazan al momento
+SESSION_MAX_QUEUED_CALLS = int(os.getenv("SESSION_MAX_QUEUED_CALLS", "16"))
+# Sesiones SSE: máximo abiertas, mensajes en cola y qué hacer si la cola se llena
+# (drop_oldest, drop_newest o close), y segundos de inactividad antes de cerrarlas.
+# Solo se descartan notificaciones: si una respuesta no cabe, se cierra la sesión
+SESSION_MAX_OPEN = int(os.getenv("SESSION_MAX_OPEN", "1000"))
+SESSION_QUEUE_SIZE = int(os.getenv("SESSION_QUEUE_SIZE", "100"))
+SESSION_OVERFLOW_POLICY = os.getenv("SESSION_OVERFLOW_POLICY", "drop_oldest")
+if SESSION_OVERFLOW_POLICY not in ("drop_oldest", "drop_newest", "close"):
+    raise ValueError(f"SESSION_OVERFLOW_POLICY desconocida: {SESSION_OVERFLOW_POLICY!r}")
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", "900"))
+
+# TTL (segundos) por herramienta; los datos "de hoy" cambian rápido
+CACHE_TTLS = {
+    "get_total_sales_today": 30,
+    "get_ad_spend_today": 30,
+    "get_dropi_wallet": 30,
+}
+
 sessions = {}
 
 # ==============================================================================
 # CLIENTE HTTP PARA LLAMAR A OTROS SERVIDORES MCP
 # ==============================================================================
 
-async def call_mcp_tool(server_url: str, tool_name: str, arguments: dict = None) -> dict:
-    """Llama a una herramienta en otro servidor MCP."""
+# Un cliente por upstream: reutiliza conexiones (DNS + TCP + TLS una sola vez)
+upstream_clients = {}
+
+# Deadline absoluto (time.monotonic) de la herramienta en curso
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def deadline_remaining():
+    """Segundos que le quedan a la herramienta en curso (None = sin deadline)."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def deadline_after_share(share: float):
+    """Deadline absoluto que consume solo `share` del tiempo restante."""
+    remaining = deadline_remaining()
+    if remaining is None:
+        return None
+    return time.monotonic() + max(0.0, remaining) * share
+
+
+@contextlib.contextmanager
+def deadline_scope(deadline):
+    """Acota el deadline actual a `deadline` (absoluto) dentro del bloque."""
+    current = _deadline.get()
+    if deadline is not None and current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline if deadline is not None else current)
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            response = await client.post(
-                f"{server_url}/call",
-                json={
-                    "name": tool_name,
-                    "arguments": arguments or {}
-                }
-            )
-            if response.status_code == 200:
-                data = response.json()
-                result = data.get("result", "")
-                
-                # Extraer JSON_DATA si existe
-                if "---JSON_DATA---" in str(result):
-                    parts = str(result).split("---JSON_DATA---")
-                    if len(parts) > 1:
-                        try:
-                            json_data = json.loads(parts[1].strip())
-                            return {"success": True, "text": parts[0].strip(), "data": json_data}
-                        except:
-                            pass
-                
-                return {"success": True, "text": result, "data": None}
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def _new_upstream_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=HTTP_HTTP2,
+    )
+
+
+def get_upstream_client(server_url: str) -> httpx.AsyncClient:
+    """Devuelve el cliente persistente del upstream (lo crea si no existe)."""
+    client = upstream_clients.get(server_url)
+    if client is None or client.is_closed:
+        client = _new_upstream_client()
+        upstream_clients[server_url] = client
+    return client
+
+
+async def open_upstream_clients():
+    for server_url in (SHOPIFY_MCP_URL, DROPI_MCP_URL, META_MCP_URL):
+        get_upstream_client(server_url)
+
+
+async def close_upstream_clients():
+    clients = list(upstream_clients.values())
+    upstream_clients.clear()
+    await asyncio.gather(*(c.aclose() for c in clients), return_exceptions=True)
+
+
+class ResponseCache:
+    """Caché en memoria con TTL y desalojo LRU por número de entradas y bytes.
+    
+    Los resultados guardados se comparten entre llamadas: son de solo lectura.
+    """
+    
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, size, value)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, _, value = entry
+        if expires_at <= time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl: float, size: int):
+        if ttl <= 0 or self.max_entries <= 0 or size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, size, value)
+        self.bytes += size
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+    
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+    
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 3) if total else 0.0,
+        }
+
+
+class SingleFlight:
+    """Une llamadas idénticas simultáneas en una sola petición al upstream.
+    
+    La petición corre en su propia task, sin el deadline de quien la creó
+    (cada llamador acota su espera con el suyo); si todos los que la esperan
+    se cancelan, se cancela también la petición.
+    """
+    
+    def __init__(self):
+        self._inflight = {}  # key -> {"task": Task, "waiters": int}
+        self.coalesced = 0
+    
+    async def do(self, key, factory):
+        entry = self._inflight.get(key)
+        if entry is None:
+            context = contextvars.copy_context()
+            context.run(_deadline.set, None)
+            entry = {"task": asyncio.create_task(factory(), context=context), "waiters": 0}
+            self._inflight[key] = entry
+            entry["task"].add_done_callback(lambda _: self._forget(key, entry))
+        else:
+            self.coalesced += 1
+        
+        entry["waiters"] += 1
+        try:
+            return await asyncio.shield(entry["task"])
+        finally:
+            entry["waiters"] -= 1
+            if entry["waiters"] == 0 and not entry["task"].done():
+                self._forget(key, entry)
+                entry["task"].cancel()
+    
+    def _forget(self, key, entry):
+        if self._inflight.get(key) is entry:
+            del self._inflight[key]
+    
+    def stats(self) -> dict:
+        return {"inflight": len(self._inflight), "coalesced": self.coalesced}
+
+
+class CircuitBreaker:
+    """Circuit breaker de un upstream.
+    
+    Cerrado: todo pasa. Tras `failure_threshold` fallos seguidos se abre y
+    rechaza al instante. Pasado `reset_timeout` queda semiabierto y deja
+    pasar una sola prueba: si sale bien se cierra, si falla se reabre.
+    """
+    
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+    
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self._probing:
+                return False
+            self._probing = True
+        return True
+    
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+    
+    def record_failure(self):
+        self._probing = False
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+    
+    def release(self):
+        """Libera la prueba semiabierta si se canceló sin resultado."""
+        self._probing = False
+
+
+circuit_breakers = {}
+
+
+def get_circuit_breaker(server_url: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(server_url)
+    if breaker is None:
+        breaker = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+        circuit_breakers[server_url] = breaker
+    return breaker
+
+
+class UpstreamLimiter:
+    """Limitador compartido de un upstream.
+    
+    Un token bucket acota las peticiones por segundo y un límite de
+    concurrencia AIMD se ajusta solo: crece +1 por ventana cuando las
+    respuestas son buenas y rápidas, y se multiplica por `backoff` ante
+    errores o latencias por encima de `latency_target`.
+    """
+    
+    def __init__(self, rate: float, burst: float, min_limit: int, max_limit: int,
+                 initial_limit: int, latency_target: float, backoff: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.refilled_at = time.monotonic()
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial_limit, self.min_limit), self.max_limit))
+        self.latency_target = latency_target
+        self.backoff = backoff
+        self.in_flight = 0
+        self._waiters = deque()
+    
+    def try_acquire(self) -> bool:
+        """Toma hueco y token solo si están libres ya (sin esperar)."""
+        if self._waiters or self.in_flight >= int(self.limit):
+            return False
+        if self.rate > 0:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        self.in_flight += 1
+        return True
+    
+    async def acquire(self):
+        await self._acquire_slot()
+        try:
+            await self._take_token()
+        except BaseException:
+            self.in_flight -= 1
+            self._wake()
+            raise
+    
+    def release(self, latency: float, ok):
+        """Libera el hueco. `ok` None (p. ej. cancelación) no ajusta el límite."""
+        self.in_flight -= 1
+        if ok is not None:
+            if ok and latency <= self.latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
             else:
-                return {"success": False, "error": f"HTTP {response.status_code}"}
+                self.limit = max(self.min_limit, self.limit * self.backoff)
+        self._wake()
+    
+    async def _acquire_slot(self):
+        while self.in_flight >= int(self.limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                else:
+                    self._wake()  # ceder el aviso que ya consumimos
+                raise
+        self.in_flight += 1
+    
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+    
+    async def _take_token(self):
+        if self.rate <= 0:
+            return
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+    
+    def stats(self) -> dict:
+        return {"limit": round(self.limit, 2), "in_flight": self.in_flight, "waiting": len(self._waiters)}
+
+
+upstream_limiters = {}
+
+
+def get_upstream_limiter(server_url: str) -> UpstreamLimiter:
+    limiter = upstream_limiters.get(server_url)
+    if limiter is None:
+        limiter = UpstreamLimiter(
+            LIMITER_RATE, LIMITER_BURST, LIMITER_MIN_CONCURRENCY, LIMITER_MAX_CONCURRENCY,
+            LIMITER_INITIAL_CONCURRENCY, LIMITER_LATENCY_TARGET, LIMITER_BACKOFF,
+        )
+        upstream_limiters[server_url] = limiter
+    return limiter
+
+
+class HedgePolicy:
+    """Cuándo mandar una petición de respaldo (hedge) y cuántas permitir.
+    
+    Guarda las latencias recientes por (upstream, herramienta); el hedge sale
+    cuando la primera petición supera el percentil configurado, y el total de
+    hedges no pasa de `max_fraction` de las peticiones.
+    """
+    
+    def __init__(self, percentile: float, min_samples: int, window: int, max_fraction: float):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_fraction = max_fraction
+        self._latencies = {}  # (server_url, tool_name) -> deque
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+    
+    def delay(self, key):
+        """Espera antes del hedge, o None si aún no hay muestras suficientes."""
+        samples = self._latencies.get(key)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(self.percentile * len(ordered)))]
+    
+    def record(self, key, latency: float):
+        samples = self._latencies.get(key)
+        if samples is None:
+            samples = self._latencies[key] = deque(maxlen=self.window)
+        samples.append(latency)
+    
+    def allow_hedge(self) -> bool:
+        return self.hedges + 1 <= self.max_fraction * self.requests
+    
+    def stats(self) -> dict:
+        return {"requests": self.requests, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+upstream_singleflight = SingleFlight()
+store_singleflight = SingleFlight()
+hedge_policy = HedgePolicy(HEDGE_PERCENTILE, HEDGE_MIN_SAMPLES, HEDGE_WINDOW, HEDGE_MAX_FRACTION)
+
+
+def _cache_key(server_url: str, tool_name: str, arguments: dict) -> tuple:
+    canonical = json.dumps(arguments or {}, sort_keys=True, separators=(",", ":"), default=str)
+    return (server_url, tool_name, canonical)
+
+
+def _cache_ttl(tool_name: str, arguments: dict) -> float:
+    if tool_name in CACHE_TTLS:
+        return CACHE_TTLS[tool_name]
+    # Rango histórico cerrado (termina antes de hoy): cambia poco
+    end_date = (arguments or {}).get("end_date")
+    if end_date and str(end_date) < date.today().isoformat():
+        return CACHE_CLOSED_RANGE_TTL
+    return CACHE_DEFAULT_TTL
+
+
+async def call_mcp_tool(server_url: str, tool_name: str, arguments: dict = None) -> dict:
+    """Llama a una herramienta en otro servidor MCP.
+    
+    Sirve desde la caché si puede y comparte las peticiones idénticas que
+    ya estén en curso.
+    """
+    key = _cache_key(server_url, tool_name, arguments)
+    cached = response_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    remaining = deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        return {"success": False, "error": "Deadline agotado", "timed_out": True}
+    
+    async def fetch():
+        result = await _fetch_with_retries(server_url, tool_name, arguments)
+        if result.get("success"):
+            size = len(key[2]) + len(json.dumps(result, default=str))
+            response_cache.set(key, result, _cache_ttl(tool_name, arguments), size)
+        return result
+    
+    try:
+        return await asyncio.wait_for(upstream_singleflight.do(key, fetch), remaining)
+    except asyncio.TimeoutError:
+        return {"success": False, "error": "Deadline agotado", "timed_out": True}
+
+
+def _is_idempotent(tool_name: str) -> bool:
+    # Las herramientas de lectura de los servidores MCP se llaman get_*
+    return tool_name.startswith("get_")
+
+
+async def _fetch_with_retries(server_url: str, tool_name: str, arguments: dict = None) -> dict:
+    """POST al upstream con reintentos (solo lecturas) y circuit breaker."""
+    breaker = get_circuit_breaker(server_url)
+    limiter = get_upstream_limiter(server_url)
+    attempts = max(1, RETRY_ATTEMPTS) if _is_idempotent(tool_name) else 1
+    
+    result = None
+    for attempt in range(attempts):
+        if not breaker.allow():
+            # Si el circuito se abrió durante los reintentos, devolver el error real
+            return result or {"success": False, "error": f"Circuito abierto para {server_url}", "circuit_open": True}
+        
+        try:
+            await limiter.acquire()
+        except BaseException:
+            breaker.release()
+            raise
+        
+        started = time.monotonic()
+        healthy = None
+        try:
+            result = await _post_with_hedging(server_url, tool_name, arguments, limiter)
+            # Un error no reintentable (p. ej. 4xx) indica que el upstream responde
+            healthy = bool(result.get("success") or not result.get("retriable"))
+        except BaseException:
+            breaker.release()
+            raise
+        finally:
+            limiter.release(time.monotonic() - started, healthy)
+        
+        if healthy:
+            breaker.record_success()
+            return result
+        
+        breaker.record_failure()
+        if attempt + 1 < attempts:
+            # Full jitter: espera aleatoria entre 0 y el backoff exponencial
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+            remaining = deadline_remaining()
+            if remaining is not None and remaining <= delay:
+                break
+            await asyncio.sleep(delay)
+    
+    return result
+
+
+async def _post_with_hedging(server_url: str, tool_name: str, arguments: dict, limiter: UpstreamLimiter) -> dict:
+    """POST al upstream; en herramientas con hedging, si la respuesta se demora
+    más que el percentil reciente se manda una copia y gana la primera buena."""
+    if not (HEDGE_ENABLED and tool_name in HEDGE_TOOLS and _is_idempotent(tool_name)):
+        return await _post_mcp_call(server_url, tool_name, arguments)
+    
+    key = (server_url, tool_name)
+    hedge_policy.requests += 1
+    delay = hedge_policy.delay(key)
+    started = time.monotonic()
+    
+    primary = asyncio.create_task(_post_mcp_call(server_url, tool_name, arguments))
+    pending = {primary}
+    hedge = None
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(pending, timeout=delay)
+            # El hedge también respeta el limitador: solo sale si hay hueco ya
+            if not done and hedge_policy.allow_hedge() and limiter.try_acquire():
+                hedge_policy.hedges += 1
+                hedge = asyncio.create_task(_post_mcp_call(server_url, tool_name, arguments))
+                hedge.add_done_callback(lambda t: limiter.release(time.monotonic() - started, None))
+                pending.add(hedge)
+        
+        while True:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=lambda t: not t.result().get("success")):
+                result = task.result()
+                if result.get("success") or not pending:
+                    if result.get("success"):
+                        hedge_policy.record(key, time.monotonic() - started)
+                        if task is hedge:
+                            hedge_policy.hedge_wins += 1
+                    return result
+    finally:
+        for task in (primary, hedge):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+async def _post_mcp_call(server_url: str, tool_name: str, arguments: dict = None) -> dict:
+    """Hace el POST /call al servidor MCP y extrae JSON_DATA."""
+    try:
+        client = get_upstream_client(server_url)
+        response = await client.post(
+            f"{server_url}/call",
+            json={
+                "name": tool_name,
+                "arguments": arguments or {}
+            }
+        )
+        if response.status_code == 200:
+            data = response.json()
+            result = data.get("result", "")
+            
+            # Extraer JSON_DATA si existe
+            if "---JSON_DATA---" in str(result):
+                parts = str(result).split("---JSON_DATA---")
+                if len(parts) > 1:
+                    try:
+                        json_data = json.loads(parts[1].strip())
+                        return {"success": True, "text": parts[0].strip(), "data": json_data}
+                    except:
+                        pass
+            
+            return {"success": True, "text": result, "data": None}
+        else:
+            retriable = response.status_code >= 500 or response.status_code == 429
+            return {"success": False, "error": f"HTTP {response.status_code}", "retriable": retriable}
+    except httpx.TransportError as e:
+        # Timeouts, conexión rechazada, DNS...: fallos transitorios
+        return {"success": False, "error": str(e) or type(e).__name__, "retriable": True}
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+
+async def call_mcp_tool_with_timeout(server_url: str, tool_name: str, arguments: dict, timeout: float) -> dict:
+    """Como call_mcp_tool, pero se rinde tras `timeout` segundos (marca timed_out)."""
+    try:
+        return await asyncio.wait_for(call_mcp_tool(server_url, tool_name, arguments), timeout)
+    except asyncio.TimeoutError:
+        return {"success": False, "error": f"Timeout ({timeout:g}s)", "timed_out": True}
+
+
+async def fetch_financial_details(order_ids: list) -> dict:
+    """Pide get_orders_financial_details en lotes concurrentes y une los resultados.
+    
+    Los pedidos se devuelven como OrderRecord. Los que están en estado final
+    salen de financial_details_cache y no se vuelven a pedir.
+    """
+    cached, order_ids = await financial_details_cache.get_many(order_ids)
+    if not order_ids:
+        return {"success": True, "text": "", "data": {"orders": cached}}
+    
+    batches = [order_ids[i:i + FINANCIAL_BATCH_SIZE] for i in range(0, len(order_ids), FINANCIAL_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(FINANCIAL_MAX_CONCURRENCY)
+    
+    async def fetch_batch(batch):
+        async with semaphore:
+            return await call_mcp_tool(DROPI_MCP_URL, "get_orders_financial_details", {"order_ids": batch})
+    
+    results = await asyncio.gather(*(fetch_batch(b) for b in batches))
+    
+    orders = []
+    errors = []
+    for result in results:
+        if result.get("success") and result.get("data"):
+            orders.extend(OrderRecord.from_detail(o) for o in result["data"].get("orders", []))
+        else:
+            errors.append(result.get("error") or "Sin datos")
+    
+    await financial_details_cache.put_many(orders)
+    
+    if len(errors) == len(batches) and not cached:
+        return {"success": False, "error": errors[0]}
+    return {"success": True, "text": "", "data": {"orders": cached + orders}, "failed_batches": len(errors)}
+
+
+async def iter_dropi_orders(start_date: str, end_date: str, page_size: int = None, deadline: float = None):
+    """Recorre get_dropi_orders página a página hasta agotar el upstream.
+    
+    Produce el resultado de call_mcp_tool de cada página. Si una página falla
+    se produce ese resultado (success=False) y se detiene el recorrido.
+    `deadline` (absoluto) acota solo las peticiones del listado.
+    """
+    page_size = page_size or DROPI_PAGE_SIZE
+    offset = 0
+    first_id = None
+    
+    for _ in range(DROPI_MAX_PAGES):
+        with deadline_scope(deadline):
+            page = await call_mcp_tool(
+                DROPI_MCP_URL,
+                "get_dropi_orders",
+                {"start_date": start_date, "end_date": end_date, "limit": page_size, "offset": offset}
+            )
+        if not page.get("success"):
+            yield page
+            return
+        
+        data = page.get("data") or {}
+        orders = data.get("orders", [])
+        
+        # Si el upstream ignora el offset devolvería la misma página otra vez
+        page_first_id = orders[0].get("id") if orders else None
+        if offset and page_first_id is not None and page_first_id == first_id:
+            return
+        if first_id is None:
+            first_id = page_first_id
+        
+        yield page
+        
+        offset += len(orders)
+        total_orders = data.get("total_orders")
+        if total_orders is not None:
+            # Con total el upstream puede devolver páginas cortas antes del final
+            if not orders or offset >= total_orders:
+                return
+        elif len(orders) < page_size:
+            return
+
+# ==============================================================================
+# PERSISTENCIA LOCAL (SQLITE)
+# ==============================================================================
+
+_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_aggregates (
+    scope TEXT NOT NULL,
+    day TEXT NOT NULL,
+    data TEXT NOT NULL,
+    computed_at REAL NOT NULL,
+    PRIMARY KEY (scope, day)
+);
+
+CREATE TABLE IF NOT EXISTS orders (
+    id NOT NULL PRIMARY KEY,
+    order_date TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT '',
+    profit REAL NOT NULL DEFAULT 0,
+    shipping_cost REAL,
+    paid INTEGER NOT NULL DEFAULT 0,
+    payment_amount REAL NOT NULL DEFAULT 0,
+    listed_at REAL NOT NULL,
+    details_at REAL,
+    last_open_status TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_orders_date ON orders (order_date);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status);
+CREATE INDEX IF NOT EXISTS idx_orders_paid ON orders (paid);
+
+CREATE TABLE IF NOT EXISTS wallet_daily (
+    day TEXT PRIMARY KEY,
+    income REAL NOT NULL DEFAULT 0,
+    expenses REAL NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS financial_details (
+    order_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    fetched_at REAL NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS synced_days (
+    day TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    synced_on TEXT NOT NULL
+);
+"""
+
+_db_conn = None
+_db_lock = threading.Lock()
+
+
+def _db_connection() -> sqlite3.Connection:
+    global _db_conn
+    if _db_conn is None:
+        conn = sqlite3.connect(ANALYTICS_DB_PATH, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_DB_SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(orders)")}
+        if "last_open_status" not in columns:
+            conn.execute("ALTER TABLE orders ADD COLUMN last_open_status TEXT")
+        _db_conn = conn
+    return _db_conn
+
+
+async def db_run(fn, *args):
+    """Ejecuta fn(conn, *args) en un hilo, serializado sobre la conexión."""
+    def run():
+        with _db_lock:
+            return fn(_db_connection(), *args)
+    return await asyncio.to_thread(run)
+
+
+def close_db():
+    global _db_conn
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+# ==============================================================================
+# AGREGADOS DIARIOS
+# ==============================================================================
+
+@dataclass
+class DailyAggregate:
+    """Métricas parciales de un día. Se suman con merge() para cubrir un rango."""
+    day: str
+    shopify_orders: int = 0
+    dropi_orders: int = 0
+    entregados: int = 0
+    devoluciones: int = 0
+    pendientes: int = 0
+    cancelados: int = 0
+    ganancia_entregados: float = 0.0
+    pagados: int = 0
+    monto_pagado: float = 0.0
+    no_pagados: int = 0
+    monto_pendiente_pago: float = 0.0
+    no_pagados_ids: list = field(default_factory=list)
+    fletes_devoluciones: float = 0.0
+    pendientes_ganancia: float = 0.0
+    pendientes_fletes: float = 0.0
+    wallet_income: float = 0.0
+    wallet_expenses: float = 0.0
+    meta_spend: float = 0.0
+    meta_clicks: int = 0
+    meta_impressions: int = 0
+    fuentes_faltantes: list = field(default_factory=list)
+    
+    def merge(self, other: "DailyAggregate"):
+        for f in fields(self):
+            if f.name == "day":
+                continue
+            value = getattr(other, f.name)
+            if f.name == "no_pagados_ids":
+                # Solo hacen falta para listarlos cuando son pocos
+                if len(self.no_pagados_ids) <= MAX_LISTED_IDS:
+                    self.no_pagados_ids = (self.no_pagados_ids + value)[:MAX_LISTED_IDS + 1]
+            elif f.name == "fuentes_faltantes":
+                self.fuentes_faltantes = sorted(set(self.fuentes_faltantes) | set(value))
+            else:
+                setattr(self, f.name, getattr(self, f.name) + value)
+    
+    def is_closed(self, today: date) -> bool:
+        """Un día está cerrado si ya no puede cambiar: tiene cierta antigüedad,
+        no le quedan pedidos pendientes ni entregas por pagar y no faltó
+        ninguna fuente."""
+        age = (today - date.fromisoformat(self.day)).days
+        return (
+            age >= CLOSED_DAY_MIN_AGE_DAYS
+            and self.pendientes == 0
+            and self.no_pagados == 0
+            and not self.fuentes_faltantes
+        )
+
+
+def days_in_range(start_date: str, end_date: str) -> list:
+    """Días YYYY-MM-DD entre start_date y end_date, ambos incluidos."""
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    if end < start:
+        raise ValueError("end_date anterior a start_date")
+    return [(start + timedelta(days=i)).isoformat() for i in range((end - start).days + 1)]
+
+
+# Los agregados dependen de qué tiendas/cuentas hay detrás de cada upstream
+_AGGREGATE_SCOPE = "|".join((SHOPIFY_MCP_URL, DROPI_MCP_URL, META_MCP_URL))
+
+
+def _select_daily_aggregates(conn, days):
+    placeholders = ",".join("?" * len(days))
+    rows = conn.execute(
+        f"SELECT data FROM daily_aggregates WHERE scope = ? AND day IN ({placeholders})",
+        (_AGGREGATE_SCOPE, *days),
+    ).fetchall()
+    return [json.loads(row[0]) for row in rows]
+
+
+def _upsert_daily_aggregates(conn, aggregates):
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO daily_aggregates (scope, day, data, computed_at) VALUES (?, ?, ?, ?)",
+            [(_AGGREGATE_SCOPE, agg.day, json.dumps(asdict(agg)), now) for agg in aggregates],
+        )
+
+
+async def load_closed_days(days: list) -> dict:
+    """Agregados de días cerrados guardados en la base local, por día."""
+    if not days:
+        return {}
+    rows = await db_run(_select_daily_aggregates, days)
+    return {row["day"]: DailyAggregate(**row) for row in rows}
+
+
+async def save_closed_days(aggregates: list):
+    if aggregates:
+        await db_run(_upsert_daily_aggregates, aggregates)
+
+# ==============================================================================
+# ALMACÉN LOCAL DE PEDIDOS DROPI
+# Los pedidos, sus detalles financieros y la wallet se guardan en SQLite y se
+# sincronizan por día: un día se vuelve a listar mientras pueda recibir
+# pedidos nuevos, y los pedidos aún no terminales o entregados sin pagar
+# refrescan su detalle financiero cuando tiene más de STORE_SYNC_MAX_AGE segundos.
+# ==============================================================================
+
+ESTADOS_ENTREGADO = ["ENTREGADO", "DELIVERED", "COMPLETADO"]
+ESTADOS_DEVOLUCION = ["DEVOLUCION", "DEVUELTO", "RETURNED", "NO ENTREGADO"]
+ESTADOS_CANCELADO = ["CANCELADO", "CANCELLED"]
+ESTADOS_TERMINALES = ESTADOS_ENTREGADO + ESTADOS_DEVOLUCION + ESTADOS_CANCELADO
+
+
+# Grupos del reporte y tabla precalculada estado -> grupo
+ENTREGADOS, DEVOLUCIONES, CANCELADOS, PENDIENTES = range(4)
+STATUS_BUCKETS = {
+    **{status: ENTREGADOS for status in ESTADOS_ENTREGADO},
+    **{status: DEVOLUCIONES for status in ESTADOS_DEVOLUCION},
+    **{status: CANCELADOS for status in ESTADOS_CANCELADO},
+}
+
+
+class OrderFrame:
+    """Pedidos de Dropi en columnas NumPy para calcular métricas con máscaras.
+    
+    `status` es el índice de cada pedido en `statuses` y `bucket` su grupo del
+    reporte según STATUS_BUCKETS. Sin detalle financiero aún (`has_details`
+    en False): ganancia del listado, flete 0 y sin pagar.
+    """
+    
+    def __init__(self, ids, statuses, status, profit, shipping_cost, paid, payment_amount, has_details):
+        self.ids = ids
+        self.statuses = statuses
+        self.status = status
+        self.profit = profit
+        self.shipping_cost = shipping_cost
+        self.paid = paid
+        self.payment_amount = payment_amount
+        self.has_details = has_details
+        buckets = np.array([STATUS_BUCKETS.get(s, PENDIENTES) for s in statuses], dtype=np.int8)
+        self.bucket = buckets[status] if len(statuses) else np.zeros(0, dtype=np.int8)
+    
+    @classmethod
+    def from_rows(cls, rows):
+        """Filas (id, status, profit, shipping_cost, paid, payment_amount, has_details)."""
+        ids, statuses, profit, shipping_cost, paid, payment_amount, has_details = (
+            zip(*rows) if rows else ((),) * 7
+        )
+        codes = {}
+        status = np.fromiter(
+            (codes.setdefault(s, len(codes)) for s in statuses), dtype=np.int32, count=len(rows)
+        )
+        return cls(
+            ids=list(ids),
+            statuses=list(codes),
+            status=status,
+            profit=np.array(profit, dtype=np.float64),
+            shipping_cost=np.array(shipping_cost, dtype=np.float64),
+            paid=np.array(paid, dtype=bool),
+            payment_amount=np.array(payment_amount, dtype=np.float64),
+            has_details=np.array(has_details, dtype=bool),
+        )
+    
+    def __len__(self):
+        return len(self.ids)
+    
+    def status_in(self, statuses) -> np.ndarray:
+        """Máscara de los pedidos cuyo estado exacto está en `statuses`."""
+        codes = [i for i, s in enumerate(self.statuses) if s in statuses]
+        return np.isin(self.status, codes)
+    
+    def bucket_counts(self) -> np.ndarray:
+        """Pedidos por grupo, indexado por ENTREGADOS, DEVOLUCIONES, ..."""
+        return np.bincount(self.bucket, minlength=4)
+    
+    def aggregate_into(self, agg):
+        entregados = self.bucket == ENTREGADOS
+        pagados = entregados & self.paid
+        no_pagados = entregados & ~self.paid
+        devoluciones = self.bucket == DEVOLUCIONES
+        pendientes = self.bucket == PENDIENTES
+        counts = self.bucket_counts()
+        
+        agg.dropi_orders += len(self)
+        agg.entregados += int(counts[ENTREGADOS])
+        agg.devoluciones += int(counts[DEVOLUCIONES])
+        agg.cancelados += int(counts[CANCELADOS])
+        agg.pendientes += int(counts[PENDIENTES])
+        agg.ganancia_entregados += float(self.profit[entregados].sum())
+        agg.pagados += int(pagados.sum())
+        agg.monto_pagado += float(self.payment_amount[pagados].sum())
+        agg.no_pagados += int(no_pagados.sum())
+        agg.monto_pendiente_pago += float(self.profit[no_pagados].sum())
+        agg.fletes_devoluciones += float(self.shipping_cost[devoluciones].sum())
+        agg.pendientes_ganancia += float(self.profit[pendientes].sum())
+        agg.pendientes_fletes += float(self.shipping_cost[pendientes].sum())
+        
+        room = MAX_LISTED_IDS + 1 - len(agg.no_pagados_ids)
+        if room > 0:
+            agg.no_pagados_ids.extend(self.ids[i] for i in np.flatnonzero(no_pagados)[:room])
+        return agg
+
+
+@dataclass(slots=True)
+class OrderRecord:
+    """Detalle financiero normalizado de un pedido (sin __dict__ por instancia)."""
+    order_id: object
+    status: str = ""
+    profit: float = 0.0
+    shipping_cost: float = 0.0
+    paid: bool = False
+    payment_amount: float = 0.0
+    
+    @classmethod
+    def from_detail(cls, detail: dict) -> "OrderRecord":
+        """Normaliza un pedido de get_orders_financial_details."""
+        get = detail.get
+        return cls(
+            get("order_id"),
+            (get("status") or "").upper(),
+            get("profit") or 0,
+            get("shipping_cost") or 0,
+            bool(get("paid")),
+            get("payment_amount") or 0,
+        )
+
+
+def _select_financial_details(conn, order_ids):
+    placeholders = ",".join("?" * len(order_ids))
+    rows = conn.execute(
+        f"SELECT data FROM financial_details WHERE order_id IN ({placeholders})",
+        order_ids,
+    ).fetchall()
+    return [OrderRecord.from_detail(json.loads(row[0])) for row in rows]
+
+
+def _insert_financial_details(conn, orders):
+    now = time.time()
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO financial_details (order_id, data, fetched_at) VALUES (?, ?, ?)",
+            [(str(o.order_id), json.dumps(asdict(o)), now) for o in orders],
+        )
+
+
+class FinancialDetailsCache:
+    """Detalles financieros de pedidos que ya no pueden cambiar.
+    
+    Devoluciones, cancelados y entregados ya pagados tienen ganancia, flete y
+    pago definitivos: se guardan sin caducidad en la tabla financial_details
+    y en memoria (LRU de `max_entries`). Un entregado sin pagar no es final,
+    porque aún cambia su estado de pago.
+    """
+    
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # str(order_id) -> detalle
+        self.hits = 0
+        self.misses = 0
+    
+    @staticmethod
+    def is_final(order: OrderRecord) -> bool:
+        if order.status in ESTADOS_ENTREGADO:
+            return order.paid
+        return order.status in ESTADOS_DEVOLUCION or order.status in ESTADOS_CANCELADO
+    
+    async def get_many(self, order_ids: list):
+        """Separa los IDs en (detalles guardados, IDs que hay que pedir)."""
+        found = {}
+        for order_id in order_ids:
+            detail = self._entries.get(str(order_id))
+            if detail is not None:
+                self._entries.move_to_end(str(order_id))
+                found[str(order_id)] = detail
+        
+        pending = [str(i) for i in order_ids if str(i) not in found]
+        if pending:
+            for chunk_start in range(0, len(pending), 500):
+                chunk = pending[chunk_start:chunk_start + 500]
+                for detail in await db_run(_select_financial_details, chunk):
+                    found[str(detail.order_id)] = detail
+                    self._remember(detail)
+        
+        missing = [i for i in order_ids if str(i) not in found]
+        self.hits += len(order_ids) - len(missing)
+        self.misses += len(missing)
+        return list(found.values()), missing
+    
+    async def put_many(self, orders: list):
+        final = [o for o in orders if o.order_id is not None and self.is_final(o)]
+        if final:
+            for detail in final:
+                self._remember(detail)
+            await db_run(_insert_financial_details, final)
+    
+    def _remember(self, detail: OrderRecord):
+        self._entries[str(detail.order_id)] = detail
+        self._entries.move_to_end(str(detail.order_id))
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+    
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+financial_details_cache = FinancialDetailsCache(FINANCIAL_CACHE_MAX_ENTRIES)
+
+
+def _open_status(status: str):
+    """El estado si el pedido aún no se resolvió; None si ya es terminal."""
+    return None if status in ESTADOS_TERMINALES else status
+
+
+def _upsert_listed_orders(conn, day, orders):
+    now = time.time()
+    rows = []
+    for o in orders:
+        if o.get("id"):
+            status = (o.get("status") or "").upper()
+            rows.append((o.get("id"), day, status, o.get("profit") or 0, now, _open_status(status)))
+    with conn:
+        # El estado del listado es el más reciente; la ganancia del detalle
+        # financiero, si ya lo tenemos, es más precisa que la del listado.
+        # last_open_status conserva el último estado visto antes de resolverse.
+        conn.executemany(
+            """
+            INSERT INTO orders (id, order_date, status, profit, listed_at, last_open_status)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                order_date = excluded.order_date,
+                status = excluded.status,
+                profit = CASE WHEN orders.details_at IS NULL THEN excluded.profit ELSE orders.profit END,
+                listed_at = excluded.listed_at,
+                last_open_status = COALESCE(excluded.last_open_status, orders.last_open_status)
+            """,
+            rows,
+        )
+
+
+def _update_financial_details(conn, orders):
+    now = time.time()
+    rows = [
+        (
+            o.status, o.profit, o.shipping_cost, 1 if o.paid else 0, o.payment_amount, now,
+            _open_status(o.status), o.order_id,
+        )
+        for o in orders if o.order_id
+    ]
+    with conn:
+        conn.executemany(
+            """
+            UPDATE orders SET status = ?, profit = ?, shipping_cost = ?, paid = ?,
+                payment_amount = ?, details_at = ?, last_open_status = COALESCE(?, last_open_status)
+            WHERE id = ?
+            """,
+            rows,
+        )
+
+
+def _select_order_frame(conn, start_date, end_date):
+    rows = conn.execute(
+        """
+        SELECT id, status, COALESCE(profit, 0), COALESCE(shipping_cost, 0), COALESCE(paid, 0),
+            COALESCE(payment_amount, 0), details_at IS NOT NULL
+        FROM orders WHERE order_date BETWEEN ? AND ?
+        """,
+        (start_date, end_date),
+    ).fetchall()
+    return OrderFrame.from_rows(rows)
+
+
+def _aggregate_orders(conn, day, agg):
+    """Acumula en `agg` los pedidos del día con reducciones vectorizadas."""
+    return _select_order_frame(conn, day, day).aggregate_into(agg)
+
+
+def _select_delivery_rate(conn, start_date, end_date):
+    """(entregados, devoluciones) entre los pedidos ya resueltos del rango."""
+    entregado = ",".join("?" * len(ESTADOS_ENTREGADO))
+    devolucion = ",".join("?" * len(ESTADOS_DEVOLUCION))
+    return conn.execute(
+        f"""
+        SELECT COALESCE(SUM(status IN ({entregado})), 0), COALESCE(SUM(status IN ({devolucion})), 0)
+        FROM orders WHERE order_date BETWEEN ? AND ?
+        """,
+        (*ESTADOS_ENTREGADO, *ESTADOS_DEVOLUCION, start_date, end_date),
+    ).fetchone()
+
+
+def _select_delivery_rates_by_status(conn, start_date, end_date):
+    """{último estado abierto: (entregados, devoluciones)} de los pedidos ya
+    resueltos del rango que se vieron antes de resolverse."""
+    entregado = ",".join("?" * len(ESTADOS_ENTREGADO))
+    devolucion = ",".join("?" * len(ESTADOS_DEVOLUCION))
+    rows = conn.execute(
+        f"""
+        SELECT last_open_status, SUM(status IN ({entregado})), SUM(status IN ({devolucion}))
+        FROM orders
+        WHERE order_date BETWEEN ? AND ? AND last_open_status IS NOT NULL
+        GROUP BY last_open_status
+        """,
+        (*ESTADOS_ENTREGADO, *ESTADOS_DEVOLUCION, start_date, end_date),
+    ).fetchall()
+    return {status: (entregados, devueltos) for status, entregados, devueltos in rows if entregados + devueltos}
+
+
+def _select_stale_open_ids(conn, day, older_than, exclude):
+    """Pedidos del día que aún pueden cambiar (no terminales, o entregados sin
+    pagar: el pago llega después de la entrega) con el detalle caducado."""
+    terminales = ",".join("?" * len(ESTADOS_TERMINALES))
+    entregado = ",".join("?" * len(ESTADOS_ENTREGADO))
+    rows = conn.execute(
+        f"""
+        SELECT id FROM orders
+        WHERE order_date = ?
+            AND (status NOT IN ({terminales}) OR (status IN ({entregado}) AND paid = 0))
+            AND (details_at IS NULL OR details_at < ?)
+        """,
+        (day, *ESTADOS_TERMINALES, *ESTADOS_ENTREGADO, older_than),
+    ).fetchall()
+    return [row[0] for row in rows if row[0] not in exclude]
+
+
+def _select_synced_day(conn, day):
+    return conn.execute("SELECT synced_at, synced_on FROM synced_days WHERE day = ?", (day,)).fetchone()
+
+
+def _mark_day_synced(conn, day):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO synced_days (day, synced_at, synced_on) VALUES (?, ?, ?)",
+            (day, time.time(), date.today().isoformat()),
+        )
+
+
+def _upsert_wallet_day(conn, day, income, expenses):
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO wallet_daily (day, income, expenses, updated_at) VALUES (?, ?, ?, ?)",
+            (day, income, expenses, time.time()),
+        )
+
+
+def _select_wallet(conn, start_date, end_date):
+    return conn.execute(
+        "SELECT COALESCE(SUM(income), 0), COALESCE(SUM(expenses), 0) FROM wallet_daily WHERE day BETWEEN ? AND ?",
+        (start_date, end_date),
+    ).fetchone()
+
+
+def _needs_listing(synced, day: str) -> bool:
+    """Un día se lista si nunca se listó, o si el último listado se hizo
+    antes de que terminara (pudo recibir pedidos después) y ya caducó."""
+    if synced is None:
+        return True
+    synced_at, synced_on = synced
+    return synced_on <= day and time.time() - synced_at > STORE_SYNC_MAX_AGE
+
+
+async def _store_financial_details(order_ids: list) -> bool:
+    financial_result = await fetch_financial_details(order_ids)
+    if financial_result.get("success") and financial_result.get("data"):
+        await db_run(_update_financial_details, financial_result["data"].get("orders", []))
+    return bool(financial_result.get("success") and not financial_result.get("failed_batches"))
+
+
+# día -> Future que se resuelve (con las fuentes fallidas hasta ese momento)
+# cuando la sincronización en curso del día termina de listar sus pedidos
+order_day_listings = {}
+
+# Sincronizaciones que siguen en segundo plano después de responder
+background_syncs = set()
+
+
+async def _sync_order_day(day: str, listed: asyncio.Future) -> set:
+    faltantes = set()
+    tasks = []
+    listed_ids = set()
+    
+    async def sync_wallet():
+        wallet_result = await call_mcp_tool(
+            DROPI_MCP_URL,
+            "get_dropi_wallet_history",
+            {"start_date": day, "end_date": day}
+        )
+        if not wallet_result.get("success"):
+            faltantes.add("wallet")
+        elif wallet_result.get("data"):
+            wallet_data = wallet_result["data"]
+            await db_run(
+                _upsert_wallet_day, day,
+                wallet_data.get("total_income") or 0, wallet_data.get("total_expenses") or 0,
+            )
+    
+    try:
+        listing = _needs_listing(await db_run(_select_synced_day, day), day)
+        if listing:
+            tasks.append(asyncio.create_task(sync_wallet()))
+            
+            # Cada página se guarda y pide sus detalles mientras llega la siguiente
+            listing_deadline = deadline_after_share(DEADLINE_LISTING_SHARE)
+            async for page in iter_dropi_orders(day, day, deadline=listing_deadline):
+                if not page.get("success"):
+                    faltantes.add("dropi")
+                    break
+                orders = (page.get("data") or {}).get("orders", [])
+                await db_run(_upsert_listed_orders, day, orders)
+                
+                order_ids = [o.get("id") for o in orders if o.get("id")]
+                listed_ids.update(order_ids)
+                if order_ids:
+                    tasks.append(asyncio.create_task(_store_financial_details(order_ids)))
+        listed.set_result(set(faltantes))
+        
+        # Pedidos ya guardados que aún pueden cambiar de estado
+        stale_ids = await db_run(_select_stale_open_ids, day, time.time() - STORE_SYNC_MAX_AGE, listed_ids)
+        if stale_ids:
+            tasks.append(asyncio.create_task(_store_financial_details(stale_ids)))
+        
+        results = await asyncio.gather(*tasks)
+        if any(ok is False for ok in results):
+            faltantes.add("dropi_detalles")
+        
+        if listing and "dropi" not in faltantes and "wallet" not in faltantes:
+            await db_run(_mark_day_synced, day)
+    finally:
+        for task in tasks:
+            task.cancel()
+        if not listed.done():
+            listed.set_result({"dropi"})
+        if order_day_listings.get(day) is listed:
+            del order_day_listings[day]
+    
+    return faltantes
+
+
+def _order_day_flight(day: str):
+    """Espera la sincronización compartida del día (la inicia si no hay una)."""
+    def factory():
+        listed = asyncio.get_running_loop().create_future()
+        order_day_listings[day] = listed
+        return _sync_order_day(day, listed)
+    return store_singleflight.do(("dropi", day), factory)
+
+
+async def sync_order_day(day: str) -> set:
+    """Sincroniza un día del almacén local con Dropi.
+    
+    Devuelve las fuentes que fallaron ("dropi", "dropi_detalles", "wallet").
+    Las sincronizaciones simultáneas del mismo día se comparten, pero cada
+    llamador espera solo hasta su propio deadline.
+    """
+    remaining = deadline_remaining()
+    if remaining is not None and remaining <= 0:
+        return {"dropi", "dropi_detalles", "wallet"}
+    try:
+        return await asyncio.wait_for(
+            _order_day_flight(day), remaining
+        )
+    except asyncio.TimeoutError:
+        return {"dropi", "dropi_detalles", "wallet"}
+
+
+async def sync_order_day_listing(day: str, timeout: float) -> set:
+    """Como sync_order_day, pero vuelve en cuanto los pedidos del día están
+    listados y guardados; los detalles y la billetera terminan en segundo plano.
+    
+    Lanza asyncio.TimeoutError si el listado no termina en `timeout` (la
+    sincronización sigue igualmente)."""
+    sync = asyncio.create_task(_order_day_flight(day))
+    background_syncs.add(sync)
+    sync.add_done_callback(background_syncs.discard)
+    # Un paso para que la task se una a la sincronización (o la inicie) y
+    # quede registrado su listado
+    await asyncio.sleep(0)
+    listed = order_day_listings.get(day)
+    if listed is None:
+        return await asyncio.wait_for(asyncio.shield(sync), timeout)
+    return await asyncio.wait_for(asyncio.shield(listed), timeout)
+
+
+async def sync_order_range(days: list) -> set:
+    """Sincroniza varios días (DAILY_MAX_CONCURRENCY a la vez)."""
+    semaphore = asyncio.Semaphore(DAILY_MAX_CONCURRENCY)
+    
+    async def sync(day):
+        async with semaphore:
+            return await sync_order_day(day)
+    
+    faltantes = set()
+    for day_faltantes in await asyncio.gather(*(sync(d) for d in days)):
+        faltantes |= day_faltantes
+    return faltantes
+
+
+@dataclass
+class OrderSnapshot:
+    """Pedidos de Dropi de un período tal como quedaron tras sincronizarlo."""
+    frame: OrderFrame
+    faltantes: set
+    fetched_at: float
+    
+    def is_fresh(self) -> bool:
+        return not self.faltantes and time.time() - self.fetched_at <= SNAPSHOT_MAX_AGE
+
+
+# (start_date, end_date) -> OrderSnapshot, LRU de SNAPSHOT_MAX_ENTRIES
+order_snapshots = OrderedDict()
+
+
+async def publish_order_snapshot(start_date: str, end_date: str, faltantes, fetched_at: float) -> OrderSnapshot:
+    """Publica los pedidos del período, ya sincronizado desde `fetched_at`."""
+    frame = await db_run(_select_order_frame, start_date, end_date)
+    snapshot = OrderSnapshot(frame, set(faltantes) & {"dropi", "dropi_detalles"}, fetched_at)
+    key = (start_date, end_date)
+    order_snapshots[key] = snapshot
+    order_snapshots.move_to_end(key)
+    while len(order_snapshots) > SNAPSHOT_MAX_ENTRIES:
+        order_snapshots.popitem(last=False)
+    return snapshot
+
+
+async def get_order_snapshot(start_date: str, end_date: str, days: list) -> OrderSnapshot:
+    """Snapshot del período; sin uno reciente y completo, sincroniza y publica otro."""
+    snapshot = order_snapshots.get((start_date, end_date))
+    if snapshot is not None and snapshot.is_fresh():
+        return snapshot
+    fetched_at = time.time()
+    faltantes = await sync_order_range(days)
+    return await publish_order_snapshot(start_date, end_date, faltantes, fetched_at)
+
 # ==============================================================================
 # HERRAMIENTAS MCP
 # ==============================================================================
@@ -97,7 +1537,12 @@ Usa start_date y end_date en formato YYYY-MM-DD.""",
                 "end_date": {
                     "type": "string",
                     "description": "Fecha fin YYYY-MM-DD (ej: 2025-12-15)"
-                }
+                },
+                "deadline_seconds": {
+                    "type": "number",
+                    "description": "Tiempo máximo total en segundos (opcional); al agotarse devuelve un reporte parcial"
+                },
+                "fresh": {"type": "boolean", "description": "Ignorar resultados precalculados (opcional)"}
             },
             "required": ["start_date", "end_date"]
         }
@@ -114,7 +1559,16 @@ Usa los datos REALES de cada pedido (ganancia y flete individual).""",
                 "start_date": {"type": "string", "description": "Fecha inicio YYYY-MM-DD"},
                 "end_date": {"type": "string", "description": "Fecha fin YYYY-MM-DD"},
                 "escenario_entregas": {"type": "integer", "description": "Cantidad que se entregarían"},
-                "escenario_devoluciones": {"type": "integer", "description": "Cantidad que serían devolución"}
+                "escenario_devoluciones": {"type": "integer", "description": "Cantidad que serían devolución"},
+                "tasas_entrega": {
+                    "type": "array",
+                    "items": {"type": "number"},
+                    "description": "Varios escenarios de una vez: % de entrega de cada uno (ej. [50, 70, 90])"
+                },
+                "curva": {"type": "boolean", "description": "Incluir en JSON_DATA la curva completa de 0% a 100% de entrega"},
+                "simulaciones": {"type": "integer", "description": "Muestras Monte Carlo a simular (ej. 10000); activa la distribución de resultados"},
+                "probabilidad_entrega": {"type": "number", "description": "% de entrega de cada pedido en la simulación (por defecto, el histórico)"},
+                "deadline_seconds": {"type": "number", "description": "Tiempo máximo total en segundos (opcional)"}
             },
             "required": ["start_date", "end_date"]
         }
@@ -124,7 +1578,10 @@ Usa los datos REALES de cada pedido (ganancia y flete individual).""",
         "description": "Resumen rápido del día de hoy: ventas, entregas, gasto ads, ganancia.",
         "inputSchema": {
             "type": "object",
-            "properties": {},
+            "properties": {
+                "deadline_seconds": {"type": "number", "description": "Tiempo máximo total en segundos (opcional)"},
+                "fresh": {"type": "boolean", "description": "Ignorar resultados precalculados (opcional)"}
+            },
             "required": []
         }
     }
@@ -134,38 +1591,57 @@ Usa los datos REALES de cada pedido (ganancia y flete individual).""",
 # IMPLEMENTACIÓN DE HERRAMIENTAS
 # ==============================================================================
 
-async def analisis_360(args: dict) -> str:
-    """Análisis 360° completo de rentabilidad."""
-    
-    start_date = args.get("start_date")
-    end_date = args.get("end_date")
-    
-    if not start_date or not end_date:
-        return "❌ Se requieren start_date y end_date en formato YYYY-MM-DD"
-    
-    period_label = f"{start_date} al {end_date}" if start_date != end_date else start_date
+async def calcular_agregado_diario(day: str, avance=None) -> DailyAggregate:
+    """Resume un día: Shopify y Meta del upstream, Dropi y wallet del almacén local.
+    
+    Si se pasa `avance`, se llama con un mensaje en cuanto responde cada fuente.
+    """
+    
+    async def fuente(nombre, coro, resumen):
+        result = await coro
+        if avance is not None:
+            avance(f"{day} · {nombre}: {resumen(result)}")
+        return result
+    
+    def resumen_upstream(clave, formato):
+        def resumen(result):
+            if not result.get("success"):
+                return "sin respuesta"
+            data = result.get("data")
+            return formato(data.get(clave, 0)) if data else "respondió"
+        return resumen
+    
+    # Shopify, Meta y la sincronización de Dropi no dependen entre sí
+    shopify_result, fuentes_faltantes, meta_result = await asyncio.gather(
+        fuente(
+            "Shopify",
+            call_mcp_tool(SHOPIFY_MCP_URL, "get_sales_by_period", {"start_date": day, "end_date": day}),
+            resumen_upstream("order_count", lambda n: f"{n} pedidos"),
+        ),
+        fuente(
+            "Dropi y wallet",
+            sync_order_day(day),
+            lambda faltan: f"sin {', '.join(sorted(faltan))}" if faltan else "sincronizado",
+        ),
+        fuente(
+            "Meta Ads",
+            call_mcp_tool(META_MCP_URL, "get_ad_spend_by_period", {"start_date": day, "end_date": day}),
+            resumen_upstream("spend", lambda spend: f"gasto {CURRENCY_SYMBOL}{spend:,.2f}"),
+        ),
+    )
+    fuentes_faltantes = set(fuentes_faltantes)
     
-    result_text = f"📊 ANÁLISIS 360° - {period_label}\n"
-    result_text += "=" * 50 + "\n\n"
+    agg = DailyAggregate(day=day)
     
     # -------------------------------------------------------------------------
-    # PASO 1: Obtener pedidos de Shopify del período
+    # PASO 1: Pedidos de Shopify del día
     # -------------------------------------------------------------------------
-    result_text += "⏳ Consultando Shopify...\n"
-    
-    shopify_result = await call_mcp_tool(
-        SHOPIFY_MCP_URL,
-        "get_sales_by_period",
-        {"start_date": start_date, "end_date": end_date}
-    )
-    
-    shopify_orders_count = 0
-    shopify_total_value = 0
+    if not shopify_result.get("success"):
+        fuentes_faltantes.add("shopify")
     
     if shopify_result.get("success"):
         if shopify_result.get("data"):
-            shopify_orders_count = shopify_result["data"].get("order_count", 0)
-            shopify_total_value = shopify_result["data"].get("total_sales", 0)
+            agg.shopify_orders = shopify_result["data"].get("order_count", 0)
         else:
             # Parsear del texto si no hay JSON
             text = shopify_result.get("text", "")
@@ -173,160 +1649,133 @@ async def analisis_360(args: dict) -> str:
                 import re
                 match = re.search(r'(\d+)\s*pedidos?', text.lower())
                 if match:
-                    shopify_orders_count = int(match.group(1))
+                    agg.shopify_orders = int(match.group(1))
     
     # -------------------------------------------------------------------------
-    # PASO 2: Obtener pedidos de Dropi del período con datos financieros
+    # PASOS 2 y 3: Pedidos de Dropi con sus detalles financieros
     # -------------------------------------------------------------------------
-    result_text += "⏳ Consultando Dropi...\n"
-    
-    dropi_result = await call_mcp_tool(
-        DROPI_MCP_URL,
-        "get_dropi_orders",
-        {"start_date": start_date, "end_date": end_date, "limit": 500}
-    )
+    await db_run(_aggregate_orders, day, agg)
     
-    dropi_orders = []
-    dropi_orders_count = 0
-    
-    if dropi_result.get("success") and dropi_result.get("data"):
-        data = dropi_result["data"]
-        dropi_orders_count = data.get("total_orders", 0)
-        dropi_orders = data.get("orders", [])
+    # -------------------------------------------------------------------------
+    # PASO 4: Wallet del día
+    # -------------------------------------------------------------------------
+    agg.wallet_income, agg.wallet_expenses = await db_run(_select_wallet, day, day)
     
     # -------------------------------------------------------------------------
-    # PASO 3: Obtener detalles financieros de cada pedido de Dropi
+    # PASO 5: Gasto de Meta Ads
     # -------------------------------------------------------------------------
+    if not meta_result.get("success"):
+        fuentes_faltantes.add("meta")
     
-    # Clasificar por estado
-    entregados = []
-    devoluciones = []
-    pendientes = []
-    cancelados = []
+    if meta_result.get("success") and meta_result.get("data"):
+        meta_data = meta_result["data"]
+        agg.meta_spend = meta_data.get("spend", 0)
+        agg.meta_clicks = meta_data.get("clicks", 0)
+        agg.meta_impressions = meta_data.get("impressions", 0)
     
-    # Si tenemos los IDs, obtener detalles completos
-    order_ids = [o.get("id") for o in dropi_orders if o.get("id")]
+    agg.fuentes_faltantes = sorted(fuentes_faltantes)
+    return agg
+
+
+async def analisis_360(args: dict) -> str:
+    """Análisis 360° completo de rentabilidad."""
     
-    # Obtener detalles financieros batch (máximo 50)
-    if order_ids:
-        result_text += f"⏳ Obteniendo detalles financieros de {len(order_ids)} pedidos...\n"
-        
-        financial_result = await call_mcp_tool(
-            DROPI_MCP_URL,
-            "get_orders_financial_details",
-            {"order_ids": order_ids[:50]}  # Limitar a 50
-        )
-        
-        if financial_result.get("success") and financial_result.get("data"):
-            fin_data = financial_result["data"]
-            
-            for order in fin_data.get("orders", []):
-                status = (order.get("status") or "").upper()
-                order_info = {
-                    "id": order.get("order_id"),
-                    "profit": order.get("profit", 0),
-                    "shipping_cost": order.get("shipping_cost", 0),
-                    "paid": order.get("paid", False),
-                    "payment_amount": order.get("payment_amount", 0)
-                }
-                
-                if status in ["ENTREGADO", "DELIVERED", "COMPLETADO"]:
-                    entregados.append(order_info)
-                elif status in ["DEVOLUCION", "DEVUELTO", "RETURNED", "NO ENTREGADO"]:
-                    devoluciones.append(order_info)
-                elif status in ["CANCELADO", "CANCELLED"]:
-                    cancelados.append(order_info)
-                else:
-                    pendientes.append(order_info)
-    
-    # Si no tenemos detalles batch, usar los datos básicos
-    if not entregados and not devoluciones and not pendientes:
-        for order in dropi_orders:
-            status = (order.get("status") or "").upper()
-            order_info = {
-                "id": order.get("id"),
-                "profit": order.get("profit", 0),
-                "shipping_cost": 0,  # No tenemos el dato individual
-                "paid": False
-            }
-            
-            if status in ["ENTREGADO", "DELIVERED", "COMPLETADO"]:
-                entregados.append(order_info)
-            elif status in ["DEVOLUCION", "DEVUELTO", "RETURNED", "NO ENTREGADO"]:
-                devoluciones.append(order_info)
-            elif status in ["CANCELADO", "CANCELLED"]:
-                cancelados.append(order_info)
-            else:
-                pendientes.append(order_info)
+    start_date = args.get("start_date")
+    end_date = args.get("end_date")
+    
+    if not start_date or not end_date:
+        return "❌ Se requieren start_date y end_date en formato YYYY-MM-DD"
+    
+    try:
+        days = days_in_range(start_date, end_date)
+    except ValueError:
+        return "❌ Fechas inválidas: usa YYYY-MM-DD y start_date <= end_date"
+    if len(days) > MAX_RANGE_DAYS:
+        return f"❌ El rango máximo es de {MAX_RANGE_DAYS} días"
+    
+    period_label = f"{start_date} al {end_date}" if start_date != end_date else start_date
     
     # -------------------------------------------------------------------------
-    # PASO 4: Obtener historial de wallet para verificar pagos
+    # AGREGADOS POR DÍA
+    # Los días cerrados salen de la caché persistente; solo se consultan los
+    # días abiertos, varios a la vez.
     # -------------------------------------------------------------------------
-    result_text += "⏳ Consultando pagos en wallet...\n"
+    agregados = await load_closed_days(days)
+    dias_abiertos = [d for d in days if d not in agregados]
+    dias_en_cache = len(days) - len(dias_abiertos)
     
-    wallet_result = await call_mcp_tool(
-        DROPI_MCP_URL,
-        "get_dropi_wallet_history",
-        {"start_date": start_date, "end_date": end_date}
-    )
+    # Avance: por cada día abierto, sus tres fuentes y su resumen; luego el reporte
+    pasos = 4 * len(dias_abiertos) + 1
+    completados = 0
     
-    total_wallet_income = 0
-    total_wallet_expenses = 0
+    def avance(message):
+        nonlocal completados
+        completados += 1
+        report_progress(completados, pasos, message)
     
-    if wallet_result.get("success") and wallet_result.get("data"):
-        wallet_data = wallet_result["data"]
-        total_wallet_income = wallet_data.get("total_income", 0)
-        total_wallet_expenses = wallet_data.get("total_expenses", 0)
+    report_progress(0, pasos, f"{dias_en_cache} días en caché; consultando Shopify, Dropi, wallet y Meta Ads ({len(dias_abiertos)} días)")
     
-    # -------------------------------------------------------------------------
-    # PASO 5: Obtener gasto de Meta Ads
-    # -------------------------------------------------------------------------
-    result_text += "⏳ Consultando Meta Ads...\n"
+    fetched_at = time.time()
+    semaphore = asyncio.Semaphore(DAILY_MAX_CONCURRENCY)
     
-    meta_result = await call_mcp_tool(
-        META_MCP_URL,
-        "get_ad_spend_by_period",
-        {"start_date": start_date, "end_date": end_date}
-    )
+    async def calcular_dia(day):
+        async with semaphore:
+            agg = await calcular_agregado_diario(day, avance)
+        faltan = f", sin {', '.join(agg.fuentes_faltantes)}" if agg.fuentes_faltantes else ""
+        avance(f"{day}: {agg.dropi_orders} pedidos Dropi, {agg.entregados} entregados{faltan}")
+        return agg
     
-    meta_spend = 0
-    meta_clicks = 0
-    meta_impressions = 0
+    for agg in await asyncio.gather(*(calcular_dia(d) for d in dias_abiertos)):
+        agregados[agg.day] = agg
     
-    if meta_result.get("success") and meta_result.get("data"):
-        meta_data = meta_result["data"]
-        meta_spend = meta_data.get("spend", 0)
-        meta_clicks = meta_data.get("clicks", 0)
-        meta_impressions = meta_data.get("impressions", 0)
+    today = date.today()
+    await save_closed_days([agregados[d] for d in dias_abiertos if agregados[d].is_closed(today)])
+    
+    total = DailyAggregate(day=period_label)
+    for d in days:
+        total.merge(agregados[d])
+    
+    # Los pedidos ya sincronizados quedan disponibles para proyeccion_pendientes
+    await publish_order_snapshot(start_date, end_date, total.fuentes_faltantes, fetched_at)
     
     # -------------------------------------------------------------------------
     # PASO 6: CALCULAR MÉTRICAS
     # -------------------------------------------------------------------------
     
+    shopify_orders_count = total.shopify_orders
+    dropi_orders_count = total.dropi_orders
+    entregados = total.entregados
+    devoluciones = total.devoluciones
+    pendientes = total.pendientes
+    cancelados = total.cancelados
+    pagados = total.pagados
+    no_pagados = total.no_pagados
+    meta_spend = total.meta_spend
+    meta_clicks = total.meta_clicks
+    meta_impressions = total.meta_impressions
+    
     # Cancelaciones
     cancelaciones_pre_envio = max(0, shopify_orders_count - dropi_orders_count)
-    cancelaciones_total = cancelaciones_pre_envio + len(cancelados)
+    cancelaciones_total = cancelaciones_pre_envio + cancelados
     tasa_cancelacion = (cancelaciones_total / shopify_orders_count * 100) if shopify_orders_count > 0 else 0
     
     # Ganancias
-    ganancia_entregados = sum(o.get("profit", 0) for o in entregados)
+    ganancia_entregados = total.ganancia_entregados
     
     # Pagos
-    pagados = [o for o in entregados if o.get("paid")]
-    no_pagados = [o for o in entregados if not o.get("paid")]
-    monto_pagado = sum(o.get("payment_amount", 0) for o in pagados)
-    monto_pendiente_pago = sum(o.get("profit", 0) for o in no_pagados)
+    monto_pagado = total.monto_pagado
+    monto_pendiente_pago = total.monto_pendiente_pago
     
     # Devoluciones - fletes reales
-    fletes_devoluciones = sum(o.get("shipping_cost", 0) for o in devoluciones)
+    fletes_devoluciones = total.fletes_devoluciones
     # Si no tenemos fletes individuales, estimar (Guatemala Q23, Colombia variable)
-    if fletes_devoluciones == 0 and len(devoluciones) > 0:
+    if fletes_devoluciones == 0 and devoluciones > 0:
         flete_promedio = 23  # Guatemala default
-        fletes_devoluciones = len(devoluciones) * flete_promedio
+        fletes_devoluciones = devoluciones * flete_promedio
     
     # Pendientes - proyección
-    ganancia_potencial_pendientes = sum(o.get("profit", 0) for o in pendientes)
-    fletes_potenciales_pendientes = sum(o.get("shipping_cost", 0) for o in pendientes)
+    ganancia_potencial_pendientes = total.pendientes_ganancia
+    fletes_potenciales_pendientes = total.pendientes_fletes
     
     # Profit neto
     ganancia_confirmada = ganancia_entregados - fletes_devoluciones
@@ -334,8 +1783,8 @@ async def analisis_360(args: dict) -> str:
     
     # Métricas
     roas = (ganancia_confirmada / meta_spend) if meta_spend > 0 else 0
-    cpa_real = (meta_spend / len(entregados)) if len(entregados) > 0 else 0
-    tasa_entrega = (len(entregados) / dropi_orders_count * 100) if dropi_orders_count > 0 else 0
+    cpa_real = (meta_spend / entregados) if entregados > 0 else 0
+    tasa_entrega = (entregados / dropi_orders_count * 100) if dropi_orders_count > 0 else 0
     
     # -------------------------------------------------------------------------
     # CONSTRUIR REPORTE
@@ -350,14 +1799,14 @@ async def analisis_360(args: dict) -> str:
    Dropi: {dropi_orders_count} pedidos
    
    ❌ Cancelaciones pre-envío: {cancelaciones_pre_envio}
-   ❌ Cancelados en Dropi: {len(cancelados)}
+   ❌ Cancelados en Dropi: {cancelados}
    📉 Tasa cancelación: {tasa_cancelacion:.1f}%
 
 📊 ESTADOS EN DROPI
-   ✅ Entregados: {len(entregados)}
-   ❌ Devoluciones: {len(devoluciones)}
-   ⏳ Pendientes: {len(pendientes)}
-   🚫 Cancelados: {len(cancelados)}
+   ✅ Entregados: {entregados}
+   ❌ Devoluciones: {devoluciones}
+   ⏳ Pendientes: {pendientes}
+   🚫 Cancelados: {cancelados}
    
    📈 Tasa de entrega: {tasa_entrega:.1f}%
 
@@ -367,12 +1816,12 @@ async def analisis_360(args: dict) -> str:
    = Ganancia confirmada: {CURRENCY_SYMBOL}{ganancia_confirmada:,.2f}
 
 💳 PAGOS DE DROPI
-   ✅ Ya pagado: {CURRENCY_SYMBOL}{monto_pagado:,.2f} ({len(pagados)} pedidos)
-   ⏳ Por pagar: {CURRENCY_SYMBOL}{monto_pendiente_pago:,.2f} ({len(no_pagados)} pedidos)
+   ✅ Ya pagado: {CURRENCY_SYMBOL}{monto_pagado:,.2f} ({pagados} pedidos)
+   ⏳ Por pagar: {CURRENCY_SYMBOL}{monto_pendiente_pago:,.2f} ({no_pagados} pedidos)
 """
 
-    if len(no_pagados) > 0 and len(no_pagados) <= 10:
-        result_text += f"   📋 IDs pendientes: {', '.join(['#' + str(o['id']) for o in no_pagados])}\n"
+    if no_pagados > 0 and no_pagados <= MAX_LISTED_IDS:
+        result_text += f"   📋 IDs pendientes: {', '.join(['#' + str(order_id) for order_id in total.no_pagados_ids])}\n"
 
     result_text += f"""
 📢 META ADS
@@ -397,26 +1846,30 @@ async def analisis_360(args: dict) -> str:
         result_text += f"\n   ⚠️ ESTÁS EN PÉRDIDA. Revisa tu CPA y tasa de devolución.\n"
 
     # Sección de pendientes
-    if len(pendientes) > 0:
+    if pendientes > 0:
         result_text += f"""
-🔮 PROYECCIÓN PENDIENTES ({len(pendientes)} pedidos)
+🔮 PROYECCIÓN PENDIENTES ({pendientes} pedidos)
    Si se entregan todos: +{CURRENCY_SYMBOL}{ganancia_potencial_pendientes:,.2f}
    Si todos son devolución: -{CURRENCY_SYMBOL}{fletes_potenciales_pendientes:,.2f}
    
    💡 Usa 'proyeccion_pendientes' para escenarios específicos
 """
 
+    faltantes = [f for f in ("shopify", "dropi", "dropi_detalles", "wallet", "meta") if f in total.fuentes_faltantes]
+    if faltantes:
+        result_text += f"\n⚠️ REPORTE PARCIAL: sin datos de {', '.join(faltantes)} (error o tiempo agotado)\n"
+
     # JSON para integración
     json_data = {
         "period": period_label,
         "shopify_orders": shopify_orders_count,
         "dropi_orders": dropi_orders_count,
         "cancelaciones_pre_envio": cancelaciones_pre_envio,
-        "cancelados_dropi": len(cancelados),
+        "cancelados_dropi": cancelados,
         "tasa_cancelacion": round(tasa_cancelacion, 2),
-        "entregados": len(entregados),
-        "devoluciones": len(devoluciones),
-        "pendientes": len(pendientes),
+        "entregados": entregados,
+        "devoluciones": devoluciones,
+        "pendientes": pendientes,
         "tasa_entrega": round(tasa_entrega, 2),
         "ganancia_entregados": round(ganancia_entregados, 2),
         "fletes_devoluciones": round(fletes_devoluciones, 2),
@@ -429,14 +1882,130 @@ async def analisis_360(args: dict) -> str:
         "profit_neto": round(profit_neto, 2),
         "pendientes_ganancia_potencial": round(ganancia_potencial_pendientes, 2),
         "pendientes_fletes_potenciales": round(fletes_potenciales_pendientes, 2),
-        "currency": CURRENCY_SYMBOL
+        "currency": CURRENCY_SYMBOL,
+        "parcial": bool(faltantes),
+        "fuentes_faltantes": faltantes,
+        "dias": len(days),
+        "dias_en_cache": dias_en_cache
     }
     
     result_text += f"\n\n---JSON_DATA---\n{json.dumps(json_data)}"
     
+    report_progress(pasos, pasos, "Reporte listo")
     return result_text
 
 
+def evaluar_escenarios(profit: np.ndarray, shipping_cost: np.ndarray, tasas) -> dict:
+    """Evalúa varias tasas de entrega (%) de una vez sobre los pedidos pendientes.
+    
+    Con k entregas el neto es la suma de (ganancia + flete) de los entregados
+    menos todos los fletes: el mejor caso entrega los k pedidos de mayor valor,
+    el peor los k de menor valor, y el esperado usa los promedios.
+    """
+    tasas = np.clip(np.asarray(tasas, dtype=np.float64), 0, 100)
+    total = len(profit)
+    entregas = np.floor(total * tasas / 100).astype(np.int64)
+    devoluciones = total - entregas
+    
+    valor = np.sort(profit + shipping_cost)
+    acumulado = np.concatenate(([0.0], np.cumsum(valor)))
+    total_fletes = shipping_cost.sum()
+    ganancia = entregas * profit.mean()
+    perdida = devoluciones * shipping_cost.mean()
+    
+    return {
+        "tasa_entrega": tasas,
+        "entregas": entregas,
+        "devoluciones": devoluciones,
+        "ganancia": ganancia,
+        "perdida": perdida,
+        "neto": ganancia - perdida,
+        "neto_peor": acumulado[entregas] - total_fletes,
+        "neto_mejor": acumulado[-1] - acumulado[total - entregas] - total_fletes,
+    }
+
+
+def escenarios_json(escenarios: dict) -> list:
+    """Una fila por escenario de evaluar_escenarios, lista para JSON_DATA."""
+    filas = []
+    for i in range(len(escenarios["tasa_entrega"])):
+        fila = {}
+        for key, values in escenarios.items():
+            fila[key] = int(values[i]) if values.dtype.kind == "i" else round(float(values[i]), 2)
+        filas.append(fila)
+    return filas
+
+
+def simular_pendientes(profit: np.ndarray, shipping_cost: np.ndarray, prob_entrega, simulaciones: int, seed=None) -> np.ndarray:
+    """Neto de cada muestra: cada pedido se entrega con su probabilidad.
+    
+    Un pedido entregado suma ganancia + flete sobre la base de perder todos
+    los fletes, así que cada bloque de muestras es un producto matriz-vector.
+    """
+    rng = np.random.default_rng(seed)
+    valor = profit + shipping_cost
+    total_fletes = shipping_cost.sum()
+    netos = np.empty(simulaciones)
+    bloque = max(1, MONTE_CARLO_BLOCK_CELLS // max(1, len(valor)))
+    for inicio in range(0, simulaciones, bloque):
+        fin = min(inicio + bloque, simulaciones)
+        entregados = rng.random((fin - inicio, len(valor))) < prob_entrega
+        netos[inicio:fin] = entregados @ valor - total_fletes
+    return netos
+
+
+_simulation_pool = None
+
+
+def get_simulation_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _simulation_pool
+    if _simulation_pool is None:
+        _simulation_pool = concurrent.futures.ProcessPoolExecutor(MONTE_CARLO_PROCESSES)
+    return _simulation_pool
+
+
+def close_simulation_pool():
+    global _simulation_pool
+    if _simulation_pool is not None:
+        _simulation_pool.shutdown(cancel_futures=True)
+        _simulation_pool = None
+
+
+async def simular_distribucion(profit: np.ndarray, shipping_cost: np.ndarray, prob_entrega, simulaciones: int) -> dict:
+    """Simula fuera del event loop y resume la distribución del neto.
+    
+    Las simulaciones grandes se reparten entre MONTE_CARLO_PROCESSES procesos,
+    cada uno con su propia semilla.
+    """
+    if MONTE_CARLO_PROCESSES > 0 and simulaciones * len(profit) >= MONTE_CARLO_POOL_MIN_CELLS:
+        loop = asyncio.get_running_loop()
+        pool = get_simulation_pool()
+        partes = np.array_split(np.arange(simulaciones), MONTE_CARLO_PROCESSES)
+        semillas = np.random.SeedSequence().spawn(len(partes))
+        resultados = await asyncio.gather(*(
+            loop.run_in_executor(pool, simular_pendientes, profit, shipping_cost, prob_entrega, len(parte), semilla)
+            for parte, semilla in zip(partes, semillas) if len(parte)
+        ))
+        netos = np.concatenate(resultados)
+    else:
+        netos = await asyncio.to_thread(simular_pendientes, profit, shipping_cost, prob_entrega, simulaciones)
+    
+    p5, p50, p95 = np.percentile(netos, [5, 50, 95])
+    return {
+        "simulaciones": simulaciones,
+        "neto_esperado": round(float(netos.mean()), 2),
+        "p5": round(float(p5), 2),
+        "p50": round(float(p50), 2),
+        "p95": round(float(p95), 2),
+        "probabilidad_perdida": round(float((netos < 0).mean()), 4),
+    }
+
+
+def _is_number(value) -> bool:
+    """int o float de JSON; True/False no cuentan como número."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
 async def proyeccion_pendientes(args: dict) -> str:
     """Calcula escenarios para pedidos pendientes."""
     
@@ -444,60 +2013,69 @@ async def proyeccion_pendientes(args: dict) -> str:
     end_date = args.get("end_date")
     escenario_entregas = args.get("escenario_entregas")
     escenario_devoluciones = args.get("escenario_devoluciones")
+    tasas_entrega = args.get("tasas_entrega") or []
+    simulaciones = args.get("simulaciones")
+    probabilidad_entrega = args.get("probabilidad_entrega")
     
     if not start_date or not end_date:
         return "❌ Se requieren start_date y end_date"
+    if not isinstance(tasas_entrega, list) or not all(_is_number(t) and 0 <= t <= 100 for t in tasas_entrega):
+        return "❌ tasas_entrega debe ser una lista de porcentajes entre 0 y 100"
+    if simulaciones is not None and not (
+        isinstance(simulaciones, int) and not isinstance(simulaciones, bool)
+        and 0 < simulaciones <= MONTE_CARLO_MAX_SIMULATIONS
+    ):
+        return f"❌ simulaciones debe ser un entero entre 1 y {MONTE_CARLO_MAX_SIMULATIONS}"
+    if probabilidad_entrega is not None and not (_is_number(probabilidad_entrega) and 0 <= probabilidad_entrega <= 100):
+        return "❌ probabilidad_entrega debe ser un porcentaje entre 0 y 100"
     
-    # Obtener pedidos pendientes de Dropi
-    dropi_result = await call_mcp_tool(
-        DROPI_MCP_URL,
-        "get_dropi_orders",
-        {"start_date": start_date, "end_date": end_date, "limit": 500}
-    )
+    try:
+        days = days_in_range(start_date, end_date)
+    except ValueError:
+        return "❌ Fechas inválidas: usa YYYY-MM-DD y start_date <= end_date"
+    if len(days) > MAX_RANGE_DAYS:
+        return f"❌ El rango máximo es de {MAX_RANGE_DAYS} días"
     
-    if not dropi_result.get("success"):
-        return f"❌ Error consultando Dropi: {dropi_result.get('error')}"
+    # Pedidos del período: del snapshot de analisis_360 si es reciente, si no
+    # se sincroniza el almacén local
+    snapshot = await get_order_snapshot(start_date, end_date, days)
+    frame = snapshot.frame
     
-    dropi_orders = dropi_result.get("data", {}).get("orders", [])
+    if not len(frame) and "dropi" in snapshot.faltantes:
+        return "❌ Error consultando Dropi: no respondió el servidor"
     
     # Filtrar pendientes
     estados_pendientes = ["PENDIENTE", "GUIA_GENERADA", "RECOLECTADO", "EN_RUTA", "EN BODEGA", "EN TRANSITO"]
-    pendientes = [o for o in dropi_orders if (o.get("status") or "").upper() in estados_pendientes or 
-                  (o.get("status") or "").upper() not in ["ENTREGADO", "DEVOLUCION", "CANCELADO"]]
+    pendientes = frame.status_in(estados_pendientes) | ~frame.status_in(["ENTREGADO", "DEVOLUCION", "CANCELADO"])
+    num_pendientes = int(pendientes.sum())
     
-    if not pendientes:
+    if not num_pendientes:
         return f"✅ No hay pedidos pendientes en el período {start_date} al {end_date}"
     
-    # Obtener detalles financieros
-    order_ids = [o.get("id") for o in pendientes if o.get("id")]
-    
-    pendientes_detalle = []
-    
-    if order_ids:
-        financial_result = await call_mcp_tool(
-            DROPI_MCP_URL,
-            "get_orders_financial_details",
-            {"order_ids": order_ids[:50]}
-        )
-        
-        if financial_result.get("success") and financial_result.get("data"):
-            pendientes_detalle = financial_result["data"].get("orders", [])
+    # Detalles financieros (los pedidos sin detalle aún no cuentan)
+    pendientes_detalle = pendientes & frame.has_details
     
     # Si no hay detalles, usar estimaciones
-    if not pendientes_detalle:
-        ganancia_promedio = 100  # Estimación
-        flete_promedio = 23  # Guatemala
-        total_pendientes = len(pendientes)
+    estimado = not pendientes_detalle.any()
+    seleccion = pendientes if estimado else pendientes_detalle
+    if estimado:
+        profit = np.full(num_pendientes, 100.0)  # Estimación
+        shipping_cost = np.full(num_pendientes, 23.0)  # Guatemala
     else:
-        total_pendientes = len(pendientes_detalle)
+        profit = frame.profit[pendientes_detalle]
+        shipping_cost = frame.shipping_cost[pendientes_detalle]
     
-    # Calcular totales
-    total_ganancia_potencial = sum(o.get("profit", 100) for o in pendientes_detalle) if pendientes_detalle else len(pendientes) * 100
-    total_fletes_potenciales = sum(o.get("shipping_cost", 23) for o in pendientes_detalle) if pendientes_detalle else len(pendientes) * 23
+    total_pendientes = len(profit)
+    total_ganancia_potencial = float(profit.sum())
+    total_fletes_potenciales = float(shipping_cost.sum())
     
     ganancia_promedio = total_ganancia_potencial / total_pendientes if total_pendientes > 0 else 0
     flete_promedio = total_fletes_potenciales / total_pendientes if total_pendientes > 0 else 0
     
+    # Todos los escenarios por tasa de entrega en una sola pasada
+    tasas_fijas = [80, 60]
+    escenarios = evaluar_escenarios(profit, shipping_cost, tasas_fijas + list(tasas_entrega))
+    
     result_text = f"""
 🔮 PROYECCIÓN DE PENDIENTES
 📅 Período: {start_date} al {end_date}
@@ -521,29 +2099,24 @@ async def proyeccion_pendientes(args: dict) -> str:
     result_text += f"❌ Si TODOS son devolución ({total_pendientes}):\n"
     result_text += f"   Pérdida: -{CURRENCY_SYMBOL}{total_fletes_potenciales:,.2f}\n\n"
     
-    # Escenario 80-20
-    entregas_80 = int(total_pendientes * 0.8)
-    devoluciones_20 = total_pendientes - entregas_80
-    ganancia_80 = entregas_80 * ganancia_promedio
-    perdida_20 = devoluciones_20 * flete_promedio
-    neto_80_20 = ganancia_80 - perdida_20
-    
-    result_text += f"📈 Escenario 80% entrega / 20% devolución:\n"
-    result_text += f"   {entregas_80} entregas × {CURRENCY_SYMBOL}{ganancia_promedio:.2f} = +{CURRENCY_SYMBOL}{ganancia_80:,.2f}\n"
-    result_text += f"   {devoluciones_20} devoluciones × {CURRENCY_SYMBOL}{flete_promedio:.2f} = -{CURRENCY_SYMBOL}{perdida_20:,.2f}\n"
-    result_text += f"   NETO: {CURRENCY_SYMBOL}{neto_80_20:,.2f}\n\n"
-    
-    # Escenario 60-40
-    entregas_60 = int(total_pendientes * 0.6)
-    devoluciones_40 = total_pendientes - entregas_60
-    ganancia_60 = entregas_60 * ganancia_promedio
-    perdida_40 = devoluciones_40 * flete_promedio
-    neto_60_40 = ganancia_60 - perdida_40
-    
-    result_text += f"📊 Escenario 60% entrega / 40% devolución:\n"
-    result_text += f"   {entregas_60} entregas × {CURRENCY_SYMBOL}{ganancia_promedio:.2f} = +{CURRENCY_SYMBOL}{ganancia_60:,.2f}\n"
-    result_text += f"   {devoluciones_40} devoluciones × {CURRENCY_SYMBOL}{flete_promedio:.2f} = -{CURRENCY_SYMBOL}{perdida_40:,.2f}\n"
-    result_text += f"   NETO: {CURRENCY_SYMBOL}{neto_60_40:,.2f}\n\n"
+    # Escenarios 80-20 y 60-40
+    for i, icono in enumerate(["📈", "📊"]):
+        tasa = tasas_fijas[i]
+        result_text += f"{icono} Escenario {tasa}% entrega / {100 - tasa}% devolución:\n"
+        result_text += f"   {escenarios['entregas'][i]} entregas × {CURRENCY_SYMBOL}{ganancia_promedio:.2f} = +{CURRENCY_SYMBOL}{escenarios['ganancia'][i]:,.2f}\n"
+        result_text += f"   {escenarios['devoluciones'][i]} devoluciones × {CURRENCY_SYMBOL}{flete_promedio:.2f} = -{CURRENCY_SYMBOL}{escenarios['perdida'][i]:,.2f}\n"
+        result_text += f"   NETO: {CURRENCY_SYMBOL}{escenarios['neto'][i]:,.2f}\n\n"
+    
+    # Escenarios pedidos en lote: neto con promedios y rango según qué pedidos se entreguen
+    if tasas_entrega:
+        result_text += f"📋 ESCENARIOS EN LOTE ({len(tasas_entrega)}):\n"
+        for i in range(len(tasas_fijas), len(escenarios["tasa_entrega"])):
+            result_text += (
+                f"   {escenarios['tasa_entrega'][i]:g}% → {escenarios['entregas'][i]} entregas / "
+                f"{escenarios['devoluciones'][i]} devoluciones: NETO {CURRENCY_SYMBOL}{escenarios['neto'][i]:,.2f} "
+                f"(entre {CURRENCY_SYMBOL}{escenarios['neto_peor'][i]:,.2f} y {CURRENCY_SYMBOL}{escenarios['neto_mejor'][i]:,.2f})\n"
+            )
+        result_text += "\n"
     
     # Escenario personalizado
     if escenario_entregas is not None and escenario_devoluciones is not None:
@@ -569,62 +2142,150 @@ async def proyeccion_pendientes(args: dict) -> str:
         result_text += f"   Necesitas entregar al menos {punto_equilibrio:.0f} pedidos ({porcentaje_minimo:.1f}%)\n"
         result_text += f"   para no perder dinero en este lote.\n"
     
+    # Simulación Monte Carlo: cada pedido se entrega o se devuelve por separado
+    simulacion = None
+    if simulaciones:
+        tasas_por_estado = {}
+        if probabilidad_entrega is not None:
+            tasa, fuente_tasa = probabilidad_entrega, "indicada"
+        else:
+            desde = (date.fromisoformat(start_date) - timedelta(days=MONTE_CARLO_HISTORY_DAYS)).isoformat()
+            entregados, devueltos = await db_run(_select_delivery_rate, desde, end_date)
+            if entregados + devueltos:
+                tasa = 100 * entregados / (entregados + devueltos)
+                fuente_tasa = f"histórica, {entregados + devueltos} pedidos resueltos"
+            else:
+                tasa, fuente_tasa = MONTE_CARLO_DEFAULT_RATE, "supuesta, sin historial"
+            
+            # Tasa propia de cada estado actual (EN_RUTA, PENDIENTE, ...) según
+            # cómo terminaron los pedidos que se vieron en ese estado; la
+            # general solo si el estado tiene pocos pedidos resueltos
+            for status, (e, d) in (await db_run(_select_delivery_rates_by_status, desde, end_date)).items():
+                if e + d >= MONTE_CARLO_MIN_STATUS_SAMPLES:
+                    tasas_por_estado[status] = 100 * e / (e + d)
+        
+        # Probabilidad por pedido: la de su estado actual o la general
+        tasa_por_codigo = np.array([tasas_por_estado.get(s, tasa) for s in frame.statuses]) / 100
+        prob_entrega = tasa_por_codigo[frame.status[seleccion]]
+        simulacion = await simular_distribucion(profit, shipping_cost, prob_entrega, simulaciones)
+        simulacion["probabilidad_entrega"] = round(tasa, 2)
+        simulacion["probabilidad_por_estado"] = {
+            status: round(t, 2) for status, t in tasas_por_estado.items()
+            if status in frame.statuses
+        }
+        
+        result_text += f"\n🎲 SIMULACIÓN ({simulaciones:,} muestras, entrega {tasa:.1f}% {fuente_tasa}):\n"
+        for status, t in simulacion["probabilidad_por_estado"].items():
+            result_text += f"   {status}: entrega {t:.1f}% (según su historial)\n"
+        result_text += f"   Neto esperado: {CURRENCY_SYMBOL}{simulacion['neto_esperado']:,.2f}\n"
+        result_text += f"   P5 / P50 / P95: {CURRENCY_SYMBOL}{simulacion['p5']:,.2f} / {CURRENCY_SYMBOL}{simulacion['p50']:,.2f} / {CURRENCY_SYMBOL}{simulacion['p95']:,.2f}\n"
+        result_text += f"   Probabilidad de pérdida: {simulacion['probabilidad_perdida'] * 100:.1f}%\n"
+    
+    json_data = {
+        "periodo": {"start": start_date, "end": end_date},
+        "pendientes": total_pendientes,
+        "estimado": estimado,
+        "ganancia_potencial": round(total_ganancia_potencial, 2),
+        "fletes_potenciales": round(total_fletes_potenciales, 2),
+        "ganancia_promedio": round(ganancia_promedio, 2),
+        "flete_promedio": round(flete_promedio, 2),
+        "escenarios": escenarios_json(escenarios),
+        "currency": CURRENCY_SYMBOL
+    }
+    if simulacion:
+        json_data["simulacion"] = simulacion
+    if args.get("curva"):
+        json_data["curva"] = escenarios_json(evaluar_escenarios(profit, shipping_cost, np.arange(101)))
+    
+    result_text += f"\n\n---JSON_DATA---\n{json.dumps(json_data)}"
+    
     return result_text
 
 
+async def resumen_dropi_hoy(today: str, timeout: float) -> dict:
+    """Conteos de hoy desde el almacén local, en cuanto el listado de Dropi
+    está guardado (los detalles se refrescan en segundo plano)."""
+    try:
+        faltantes = await sync_order_day_listing(today, timeout)
+    except asyncio.TimeoutError:
+        return {"success": False, "error": f"Timeout ({timeout:g}s)", "timed_out": True}
+    
+    frame = await db_run(_select_order_frame, today, today)
+    if not len(frame) and "dropi" in faltantes:
+        return {"success": False, "error": "Dropi no respondió"}
+    
+    counts = frame.bucket_counts()
+    
+    return {"success": True, "data": {
+        "total_orders": len(frame),
+        "delivered": int(counts[ENTREGADOS]),
+        "returned": int(counts[DEVOLUCIONES]),
+        "pending": int(counts[PENDIENTES]),
+    }}
+
+
 async def resumen_rapido(args: dict) -> str:
     """Resumen rápido del día de hoy."""
     
-    from datetime import date
     today = date.today().isoformat()
     
     result_text = f"📊 RESUMEN RÁPIDO - {today}\n"
     result_text += "=" * 40 + "\n\n"
     
-    # Shopify hoy
-    shopify_result = await call_mcp_tool(
-        SHOPIFY_MCP_URL,
-        "get_total_sales_today",
-        {}
+    # Las cuatro fuentes en paralelo, cada una con su propio timeout corto
+    # (nunca más allá del deadline de la herramienta)
+    timeout = RESUMEN_SOURCE_TIMEOUT
+    remaining = deadline_remaining()
+    if remaining is not None:
+        timeout = max(0.0, min(timeout, remaining))
+    shopify_result, dropi_result, meta_result, wallet_result = await asyncio.gather(
+        call_mcp_tool_with_timeout(SHOPIFY_MCP_URL, "get_total_sales_today", {}, timeout),
+        resumen_dropi_hoy(today, timeout),
+        call_mcp_tool_with_timeout(META_MCP_URL, "get_ad_spend_today", {}, timeout),
+        call_mcp_tool_with_timeout(DROPI_MCP_URL, "get_dropi_wallet", {}, timeout),
     )
     
+    def sin_datos(result: dict) -> str:
+        if result.get("timed_out"):
+            return f"   ⏱️ Sin respuesta en {timeout:.1f}s"
+        return f"   ⚠️ Error: {result.get('error') or 'sin respuesta'}"
+    
+    # Shopify hoy
     if shopify_result.get("success"):
         result_text += f"🛒 SHOPIFY:\n{shopify_result.get('text', 'Sin datos')}\n\n"
+    else:
+        result_text += f"🛒 SHOPIFY:\n{sin_datos(shopify_result)}\n\n"
     
     # Dropi hoy
-    dropi_result = await call_mcp_tool(
-        DROPI_MCP_URL,
-        "get_dropi_orders",
-        {"days": 1}
-    )
-    
     if dropi_result.get("success"):
-        data = dropi_result.get("data", {})
+        data = dropi_result.get("data") or {}
         result_text += f"📦 DROPI:\n"
         result_text += f"   Pedidos: {data.get('total_orders', 0)}\n"
         result_text += f"   Entregados: {data.get('delivered', 0)}\n"
         result_text += f"   Devoluciones: {data.get('returned', 0)}\n"
         result_text += f"   Pendientes: {data.get('pending', 0)}\n\n"
+    else:
+        result_text += f"📦 DROPI:\n{sin_datos(dropi_result)}\n\n"
     
     # Meta hoy
-    meta_result = await call_mcp_tool(
-        META_MCP_URL,
-        "get_ad_spend_today",
-        {}
-    )
-    
     if meta_result.get("success"):
         result_text += f"📢 META ADS:\n{meta_result.get('text', 'Sin datos')}\n\n"
+    else:
+        result_text += f"📢 META ADS:\n{sin_datos(meta_result)}\n\n"
     
     # Wallet
-    wallet_result = await call_mcp_tool(
-        DROPI_MCP_URL,
-        "get_dropi_wallet",
-        {}
-    )
-    
     if wallet_result.get("success"):
         result_text += f"💰 WALLET:\n{wallet_result.get('text', 'Sin datos')}\n"
+    else:
+        result_text += f"💰 WALLET:\n{sin_datos(wallet_result)}\n"
+    
+    faltantes = [
+        nombre for nombre, result in (
+            ("shopify", shopify_result), ("dropi", dropi_result), ("meta", meta_result), ("wallet", wallet_result),
+        ) if not result.get("success")
+    ]
+    if faltantes:
+        result_text += f"\n⚠️ REPORTE PARCIAL: sin datos de {', '.join(faltantes)} (error o tiempo agotado)\n"
     
     return result_text
 
@@ -639,16 +2300,165 @@ TOOL_HANDLERS = {
     "resumen_rapido": resumen_rapido,
 }
 
+def _tool_deadline(name: str, args: dict):
+    """Deadline absoluto: el que pide el cliente o, si no pide uno válido, el
+    default de la herramienta."""
+    for seconds in (args.get("deadline_seconds"), TOOL_DEADLINES.get(name)):
+        if isinstance(seconds, bool):
+            continue
+        try:
+            seconds = float(seconds)
+        except (TypeError, ValueError):
+            continue
+        if seconds > 0:
+            return time.monotonic() + seconds
+    return None
+
+
+# Avance de la herramienta en curso: callable(progress, total, message) o None
+_progress = contextvars.ContextVar("progress", default=None)
+
+
+def report_progress(progress: float, total: float = None, message: str = None):
+    """Informa del avance al cliente que lo pidió (no hace nada si nadie lo pidió)."""
+    reporter = _progress.get()
+    if reporter is not None:
+        reporter(progress, total, message)
+
+
+@contextlib.contextmanager
+def progress_scope(reporter):
+    token = _progress.set(reporter)
+    try:
+        yield
+    finally:
+        _progress.reset(token)
+
+
 async def execute_tool(name: str, args: dict) -> str:
+    args = args or {}
+    if not isinstance(args, dict):
+        return "❌ arguments debe ser un objeto JSON"
+    if not args.get("fresh"):
+        warm = serve_warm_result(name, args)
+        if warm is not None:
+            return warm
+    return await run_tool(name, args)
+
+
+async def run_tool(name: str, args: dict) -> str:
+    """Ejecuta la herramienta (sin resultados precalculados) bajo su deadline."""
     handler = TOOL_HANDLERS.get(name)
     if handler:
+        token = _deadline.set(_tool_deadline(name, args))
         try:
             return await handler(args)
         except Exception as e:
             import traceback
             return f"Error ejecutando {name}: {str(e)}\n{traceback.format_exc()}"
+        finally:
+            _deadline.reset(token)
     return f"Herramienta '{name}' no encontrada"
 
+# ==============================================================================
+# PRECÁLCULO EN SEGUNDO PLANO
+# ==============================================================================
+
+# (herramienta, argumentos canónicos) -> (texto, time.time() del cálculo)
+warm_results = {}
+
+
+def _warm_key(name: str, args: dict) -> tuple:
+    relevant = {k: v for k, v in (args or {}).items() if k not in ("deadline_seconds", "fresh")}
+    return (name, json.dumps(relevant, sort_keys=True, separators=(",", ":"), default=str))
+
+
+def serve_warm_result(name: str, args: dict):
+    """Resultado precalculado si existe y no supera PREFETCH_MAX_STALENESS."""
+    entry = warm_results.get(_warm_key(name, args))
+    if entry is None:
+        return None
+    text, computed_at = entry
+    age = time.time() - computed_at
+    if age > PREFETCH_MAX_STALENESS:
+        return None
+    
+    note = f"🕒 Precalculado hace {age:.0f}s\n"
+    if "---JSON_DATA---" in text:
+        body, data = text.split("---JSON_DATA---", 1)
+        try:
+            json_data = json.loads(data.strip())
+            json_data["edad_segundos"] = round(age)
+            return f"{note}{body}---JSON_DATA---\n{json.dumps(json_data)}"
+        except ValueError:
+            pass
+    return note + text
+
+
+def _is_complete(text: str) -> bool:
+    """Los errores y los reportes parciales no se sirven como precalculados."""
+    if text.startswith(("❌", "Error", "Herramienta")) or "⏱️" in text or "⚠️ REPORTE PARCIAL" in text:
+        return False
+    if "---JSON_DATA---" in text:
+        try:
+            return not json.loads(text.split("---JSON_DATA---", 1)[1].strip()).get("parcial")
+        except ValueError:
+            return True
+    return True
+
+
+async def prefetch(name: str, args: dict):
+    text = await run_tool(name, args)
+    if _is_complete(text):
+        now = time.time()
+        # Los días ya fuera de la ventana de precálculo no se vuelven a servir
+        for key in [k for k, (_, computed_at) in warm_results.items() if now - computed_at > PREFETCH_MAX_STALENESS]:
+            del warm_results[key]
+        warm_results[_warm_key(name, args)] = (text, now)
+
+
+class PrefetchScheduler:
+    """Recalcula cada cierto tiempo el resumen de hoy y analisis_360 de los
+    últimos PREFETCH_ANALISIS_DAYS días (cada día y el rango completo)."""
+    
+    def __init__(self):
+        self._tasks = []
+    
+    def start(self):
+        jobs = [
+            (PREFETCH_RESUMEN_INTERVAL, self._warm_resumen),
+            (PREFETCH_ANALISIS_INTERVAL, self._warm_analisis),
+        ]
+        self._tasks = [asyncio.create_task(self._every(interval, job)) for interval, job in jobs if interval > 0]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    async def _every(self, interval: float, job):
+        while True:
+            try:
+                await job()
+            except Exception:
+                logger.exception("Precálculo fallido")
+            await asyncio.sleep(interval)
+    
+    async def _warm_resumen(self):
+        await prefetch("resumen_rapido", {})
+    
+    async def _warm_analisis(self):
+        today = date.today()
+        days = [(today - timedelta(days=i)).isoformat() for i in range(PREFETCH_ANALISIS_DAYS)]
+        for day in days:
+            await prefetch("analisis_360", {"start_date": day, "end_date": day})
+        if len(days) > 1:
+            await prefetch("analisis_360", {"start_date": days[-1], "end_date": days[0]})
+
+
+prefetch_scheduler = PrefetchScheduler()
+
 # ==============================================================================
 # ENDPOINTS HTTP
 # ==============================================================================
@@ -663,28 +2473,162 @@ async def http_call_tool(request):
     result = await execute_tool(name, args)
     return JSONResponse({"result": result})
 
+class McpSession:
+    """Sesión SSE: cola acotada de mensajes hacia el cliente y sus llamadas en curso."""
+    
+    def __init__(self):
+        self.id = secrets.token_urlsafe(16)
+        self.queue = asyncio.Queue(maxsize=SESSION_QUEUE_SIZE)
+        self.tasks = set()
+        self.calls = {}  # id de la petición JSON-RPC -> Task
+        self.call_slots = asyncio.Semaphore(SESSION_MAX_CONCURRENT_CALLS)
+        self.last_activity = time.monotonic()
+        self.dropped = 0
+        self.closed = False
+    
+    def touch(self):
+        self.last_activity = time.monotonic()
+    
+    def is_idle(self, now: float) -> bool:
+        return not self.tasks and now - self.last_activity > SESSION_IDLE_TIMEOUT
+    
+    def send(self, message: dict) -> bool:
+        """Encola `message`; si la cola está llena aplica SESSION_OVERFLOW_POLICY.
+        
+        Solo se descartan notificaciones: una respuesta (mensaje con "id") que
+        no cabe cierra la sesión en vez de perderse en silencio."""
+        if self.closed:
+            return False
+        if self.queue.full():
+            self.dropped += 1
+            if SESSION_OVERFLOW_POLICY == "close":
+                self.close()
+                return False
+            is_response = "id" in message
+            if SESSION_OVERFLOW_POLICY == "drop_newest" and not is_response:
+                return False
+            if not self._drop_oldest_notification():
+                if is_response:
+                    logger.warning("Sesión %s cerrada: cola llena de respuestas", self.id)
+                    self.close()
+                return False
+        self.queue.put_nowait(message)
+        return True
+    
+    def _drop_oldest_notification(self) -> bool:
+        """Saca de la cola la notificación más antigua; False si solo hay respuestas."""
+        pending = [self.queue.get_nowait() for _ in range(self.queue.qsize())]
+        victim = next((i for i, m in enumerate(pending) if "id" not in m), None)
+        if victim is not None:
+            del pending[victim]
+        for m in pending:
+            self.queue.put_nowait(m)
+        return victim is not None
+    
+    def close(self):
+        """Saca la sesión de `sessions`, cancela sus llamadas y termina su stream SSE."""
+        if self.closed:
+            return
+        self.closed = True
+        sessions.pop(self.id, None)
+        for task in list(self.tasks):
+            task.cancel()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+    
+    def start(self, coro, request_id=None) -> asyncio.Task:
+        """Ejecuta `coro` en segundo plano, registrada en la sesión (y con
+        `request_id` para poder cancelarla)."""
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        if request_id is not None:
+            self.calls[request_id] = task
+            task.add_done_callback(lambda _: self._forget_call(request_id, task))
+        return task
+    
+    def _forget_call(self, request_id, task):
+        if self.calls.get(request_id) is task:
+            del self.calls[request_id]
+    
+    def cancel(self, request_id) -> bool:
+        """Cancela la llamada `request_id`; las peticiones al upstream que nadie
+        más espera se cancelan con ella."""
+        task = self.calls.get(request_id)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+async def evict_idle_sessions():
+    """Cierra cada minuto las sesiones sin actividad ni llamadas en curso."""
+    while True:
+        await asyncio.sleep(min(60.0, SESSION_IDLE_TIMEOUT))
+        now = time.monotonic()
+        for session in [s for s in sessions.values() if s.is_idle(now)]:
+            session.close()
+
 async def sse_endpoint(request):
-    queue = asyncio.Queue()
-    session_id = str(id(queue))
-    sessions[session_id] = queue
+    if len(sessions) >= SESSION_MAX_OPEN:
+        return Response("Too many sessions", status_code=503)
+    
+    session = McpSession()
+    sessions[session.id] = session
     
     async def gen():
         try:
-            yield {"event": "endpoint", "data": f"/messages/{session_id}"}
+            yield {"event": "endpoint", "data": f"/messages/{session.id}"}
             while True:
-                data = await queue.get()
+                data = await session.queue.get()
+                if data is None:
+                    break
+                session.touch()
                 yield {"event": "message", "data": json.dumps(data)}
         except asyncio.CancelledError:
             pass
         finally:
-            sessions.pop(session_id, None)
+            session.close()
     
     return EventSourceResponse(gen())
 
+def session_progress_reporter(session: McpSession, progress_token):
+    """Envía notifications/progress por la cola SSE de la sesión, si el
+    cliente mandó un progressToken."""
+    if progress_token is None:
+        return None
+    
+    def report(progress, total=None, message=None):
+        params = {"progressToken": progress_token, "progress": progress}
+        if total is not None:
+            params["total"] = total
+        if message:
+            params["message"] = message
+        session.send({"jsonrpc": "2.0", "method": "notifications/progress", "params": params})
+    
+    return report
+
+async def session_tool_call(session: McpSession, msg_id, params: dict):
+    """Ejecuta tools/call (hasta SESSION_MAX_CONCURRENT_CALLS a la vez por
+    sesión) y envía el resultado por la cola SSE."""
+    try:
+        async with session.call_slots:
+            progress_token = (params.get("_meta") or {}).get("progressToken")
+            with progress_scope(session_progress_reporter(session, progress_token)):
+                result = await execute_tool(params.get("name", ""), params.get("arguments", {}))
+        resp = {"jsonrpc": "2.0", "id": msg_id, "result": {"content": [{"type": "text", "text": result}]}}
+    except Exception as e:
+        # Sin esto el cliente esperaría para siempre la respuesta de msg_id
+        logger.exception("tools/call fallido")
+        resp = {"jsonrpc": "2.0", "id": msg_id, "error": {"code": -32603, "message": str(e)}}
+    if msg_id is not None:
+        session.send(resp)
+
 async def messages_endpoint(request):
-    session_id = request.path_params["session_id"]
-    if session_id not in sessions:
+    session = sessions.get(request.path_params["session_id"])
+    if session is None:
         return Response("Not found", status_code=404)
+    session.touch()
     
     body = await request.json()
     method = body.get("method", "")
@@ -703,30 +2647,73 @@ async def messages_endpoint(request):
     elif method == "tools/list":
         resp = {"jsonrpc": "2.0", "id": msg_id, "result": {"tools": TOOLS}}
     elif method == "tools/call":
-        params = body.get("params", {})
-        result = await execute_tool(params.get("name", ""), params.get("arguments", {}))
-        resp = {"jsonrpc": "2.0", "id": msg_id, "result": {"content": [{"type": "text", "text": result}]}}
+        params = body.get("params") or {}
+        if not isinstance(params, dict):
+            resp = {"jsonrpc": "2.0", "id": msg_id, "error": {"code": -32602, "message": "params debe ser un objeto"}}
+        elif len(session.tasks) >= SESSION_MAX_CONCURRENT_CALLS + SESSION_MAX_QUEUED_CALLS:
+            resp = {"jsonrpc": "2.0", "id": msg_id, "error": {"code": -32000, "message": "Demasiadas llamadas en curso en esta sesión"}}
+        else:
+            # La respuesta llega por SSE cuando termine; el POST no espera
+            session.start(session_tool_call(session, msg_id, params), msg_id)
+            resp = None
+    elif method == "notifications/cancelled":
+        # Sin respuesta: la llamada cancelada tampoco envía la suya
+        session.cancel((body.get("params") or {}).get("requestId"))
+        resp = None
     else:
         resp = {"jsonrpc": "2.0", "id": msg_id, "result": {}}
     
     if resp and msg_id:
-        await sessions[session_id].put(resp)
+        session.send(resp)
     
-    return Response("OK")
+    return Response("Accepted", status_code=202)
 
 async def health(request):
     return JSONResponse({
         "status": "ok",
         "version": "1.0.0",
         "service": "Analytics MCP - Análisis 360°",
-        "tools": len(TOOLS)
+        "tools": len(TOOLS),
+        "cache": response_cache.stats(),
+        "singleflight": upstream_singleflight.stats(),
+        "circuits": {url: breaker.state for url, breaker in circuit_breakers.items()},
+        "limiters": {url: limiter.stats() for url, limiter in upstream_limiters.items()},
+        "hedging": hedge_policy.stats(),
+        "financial_cache": financial_details_cache.stats(),
+        "order_snapshots": len(order_snapshots),
+        "sessions": {
+            "open": len(sessions),
+            "tool_calls": sum(len(s.tasks) for s in sessions.values()),
+            "dropped_messages": sum(s.dropped for s in sessions.values()),
+        },
+        "warm_results": len(warm_results)
     })
 
 # ==============================================================================
 # APP
 # ==============================================================================
 
-app = Starlette(routes=[
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await open_upstream_clients()
+    if PREFETCH_ENABLED:
+        prefetch_scheduler.start()
+    session_evictor = asyncio.create_task(evict_idle_sessions())
+    try:
+        yield
+    finally:
+        session_evictor.cancel()
+        for task in list(background_syncs):
+            task.cancel()
+        for session in list(sessions.values()):
+            session.close()
+        await prefetch_scheduler.stop()
+        await close_upstream_clients()
+        close_simulation_pool()
+        close_db()
+
+
+app = Starlette(lifespan=lifespan, routes=[
     Route("/", health),
     Route("/health", health),
     Route("/tools", http_tools),